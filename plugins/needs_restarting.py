@@ -17,7 +17,7 @@
 # License and may only be used or replicated with the express permission of
 # Red Hat, Inc.
 #
-# the mechanism of scanning smaps for opened files and matching them back to
+# the mechanism of scanning maps for opened files and matching them back to
 # packages is heavily inspired by the original needs-restarting.py:
 # http://yum.baseurl.org/gitweb?p=yum-utils.git;a=blob;f=needs-restarting.py
 
@@ -29,68 +29,154 @@ from dnfpluginscore import logger, _
 
 import dnf
 import dnf.cli
+import dnf.exceptions
 import dnfpluginscore
+import errno
 import functools
+import multiprocessing.pool
 import os
 import re
 import stat
 
+# number of processes a thread scans at once
+SCAN_CHUNK = 16
+# mapped paths of devices, shared memory and other files not from packages
+PSEUDO_PATHS = ('/SYSV', '/anon_hugepage', '/dev/', '/drm mm object',
+                '/memfd:', '/proc/', '/sys/')
+# units systemd puts processes in
+RE_UNIT = re.compile(r'\.(service|scope)$')
+RE_USER_MANAGER = re.compile(r'^user@\d+\.service$')
 
-def list_opened_files(uid):
-    for (pid, smaps) in list_smaps():
-        try:
-            if uid is not None and uid != owner_uid(smaps):
-                continue
-            with open(smaps, 'r') as smaps_file:
-                lines = smaps_file.readlines()
-        except EnvironmentError:
-            logger.warning("Failed to read PID %d's smaps.", pid)
-            continue
-
-        for line in lines:
-            ofile = smap2opened_file(pid, line)
-            if ofile is not None:
-                yield ofile
 
-
-def list_smaps():
+def list_pids():
     for dir_ in os.listdir('/proc'):
         try:
-            pid = int(dir_)
+            yield int(dir_)
         except ValueError:
             continue
-        smaps = '/proc/%d/smaps' % pid
-        yield (pid, smaps)
 
 
-def memoize(func):
-    sentinel = object()
-    cache = {}
-    def wrapper(param):
-        val = cache.get(param, sentinel)
-        if val is not sentinel:
-            return val
-        val = func(param)
-        cache[param] = val
-        return val
-    return wrapper
+def scan_process(pid, uid, process_start, services=False):
+    """Return the pid, start time, opened files and unit of the process.
+
+    The start time is None if there is no process_start to read it, the
+    systemd unit is only read with services. None is returned for processes
+    not owned by uid and for processes that have exited in the meantime.
+
+    """
+    maps = '/proc/%d/maps' % pid
+    try:
+        if uid is not None and uid != owner_uid(maps):
+            return None
+        start = None if process_start is None else process_start(pid)
+        unit = read_unit('/proc/%d/cgroup' % pid) if services else None
+        return (pid, start, read_maps(pid, maps), unit)
+    except EnvironmentError as e:
+        if e.errno not in (errno.ENOENT, errno.ESRCH):
+            logger.warning("Failed to read PID %d's maps.", pid)
+        return None
+
+
+def scan_processes(uid, process_start, jobs, services=False):
+    """Yield (pid, start time, opened files, unit) of the running processes.
+
+    The processes are scanned by jobs threads, the results are yielded as
+    soon as the scans finish. Only reading /proc is parallel, the owners of
+    the mapped files are looked up by a single query once the whole scan is
+    done.
+
+    """
+    scan = functools.partial(scan_process, uid=uid,
+                             process_start=process_start, services=services)
+    pool = multiprocessing.pool.ThreadPool(jobs)
+    try:
+        for result in pool.imap_unordered(scan, list_pids(), SCAN_CHUNK):
+            if result is not None:
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def read_unit(cgroup):
+    """Return the systemd service of the process, None if there is none.
+
+    The unit is the innermost one in the path of the systemd cgroup. Scopes,
+    like login sessions or init.scope, can not be restarted and give None.
+    Services of a user manager are returned followed by the manager, e.g.
+    'gnome-terminal.service (user@1000.service)'.
+
+    """
+    with open(cgroup) as cgroup_file:
+        for line in cgroup_file:
+            (_hierarchy, controllers, path) = line.rstrip('\n').split(':', 2)
+            # the named systemd hierarchy of cgroup v1 or the v2 one
+            if controllers not in ('name=systemd', ''):
+                continue
+            units = [name for name in path.split('/')
+                     if RE_UNIT.search(name)]
+            if not units or not units[-1].endswith('.service'):
+                return None
+            managers = [unit for unit in units[:-1]
+                        if RE_USER_MANAGER.match(unit)]
+            if managers:
+                return '%s (%s)' % (units[-1], managers[-1])
+            return units[-1]
+    return None
+
+
+def read_maps(pid, maps):
+    """Return files mapped by the process, each of them once.
+
+    A library is usually mapped several times, once for every segment.
+
+    """
+    ofiles = []
+    seen = set()
+    with open(maps, 'r') as maps_file:
+        for line in maps_file:
+            ofile = map2opened_file(pid, line)
+            if ofile is None or (ofile.name, ofile.deleted) in seen:
+                continue
+            seen.add((ofile.name, ofile.deleted))
+            ofiles.append(ofile)
+    return ofiles
 
 
 def owner_uid(fname):
     return os.stat(fname)[stat.ST_UID]
 
 
-def owning_package(sack, fname):
-    matches = sack.query().filter(file=fname).run()
-    if matches:
-        return matches[0]
-    return None
+def owning_packages(sack, fnames):
+    """Return a dict of the fnames owned by installed packages to them.
+
+    All the files are looked up by a single query, the matched packages
+    are then searched for which of the files they own.
+
+    """
+    fnames = set(fnames)
+    owners = {}
+    if not fnames:
+        return owners
+    matches = sack.query().installed().filter(file=list(fnames)).run()
+    for pkg in matches:
+        for fname in pkg.files:
+            if fname in fnames:
+                owners.setdefault(fname, pkg)
+    return owners
 
 
 def parse_args(args):
     parser = dnfpluginscore.ArgumentParser(NeedsRestartingCommand.aliases[0])
     parser.add_argument('-u', '--useronly', action='store_true',
                         help=_("only consider this user's processes"))
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=4,
+                        help=_('scan the processes in N threads'))
+    parser.add_argument('--by-inode', dest='by_inode', action='store_true',
+                        help=_('detect replaced files by their inodes instead '
+                               'of install times of packages'))
+    parser.add_argument('-s', '--services', action='store_true',
+                        help=_('only report affected systemd units'))
     return parser.parse_args(args)
 
 
@@ -102,26 +188,70 @@ def print_cmd(pid):
     print('%d : %s' % (pid, command))
 
 
-def smap2opened_file(pid, line):
-    slash = line.find('/')
-    if slash < 0:
+def map2opened_file(pid, line):
+    # address perms offset dev inode pathname, the pathname can have spaces
+    fields = line.split(None, 5)
+    if len(fields) < 6 or not fields[5].startswith('/'):
         return None
-    if line.find('00:') >= 0:
-        # not a regular file
+    fn = fields[5].rstrip('\n')
+    (major, minor) = fields[3].split(':')
+    dev = os.makedev(int(major, 16), int(minor, 16))
+    inode = int(fields[4])
+    # btrfs and overlayfs files have devices of major 0 too, so devices can
+    # not tell regular files
+    if inode == 0 or fn.startswith(PSEUDO_PATHS):
         return None
-    fn = line[slash:].strip()
     suffix_index = fn.rfind(' (deleted)')
     if suffix_index < 0:
-        return OpenedFile(pid, fn, False)
+        return OpenedFile(pid, fn, False, inode, dev)
     else:
-        return OpenedFile(pid, fn[:suffix_index], True)
+        return OpenedFile(pid, fn[:suffix_index], True, inode, dev)
+
+
+def replaced_files(ofiles):
+    """Return the opened files that are no longer the files at their paths.
+
+    A file is replaced if it has been deleted or if another file, i.e.
+    another device and inode, is found at its path now. The path is looked up under the root directory of the
+    process, so that files of processes in containers are found in their
+    own file systems. Every path is stat'ed once per root directory.
+
+    """
+    roots = {}
+    inodes = {}
+    replaced = []
+    for ofile in ofiles:
+        if not ofile.deleted:
+            root = '/proc/%d/root' % ofile.pid
+            if ofile.pid not in roots:
+                try:
+                    st = os.stat(root)
+                    roots[ofile.pid] = (st.st_dev, st.st_ino)
+                except OSError:
+                    # the process has exited
+                    roots[ofile.pid] = None
+            if roots[ofile.pid] is None:
+                continue
+            key = (roots[ofile.pid], ofile.name)
+            if key not in inodes:
+                try:
+                    st = os.stat(root + ofile.name)
+                    inodes[key] = (st.st_dev, st.st_ino)
+                except OSError:
+                    inodes[key] = None
+            if inodes[key] == (ofile.dev, ofile.inode):
+                continue
+        replaced.append(ofile)
+    return replaced
 
 
 class OpenedFile(object):
     RE_TRANSACTION_FILE = re.compile('^(.+);[0-9A-Fa-f]{8,}$')
 
-    def __init__(self, pid, name, deleted):
+    def __init__(self, pid, name, deleted, inode=None, dev=None):
         self.deleted = deleted
+        self.dev = dev
+        self.inode = inode
         self.name = name
         self.pid = pid
 
@@ -184,24 +314,70 @@ class NeedsRestartingCommand(dnf.cli.Command):
     summary = _('determine updated binaries that need restarting')
     usage = ''
 
-    def configure(self, _):
+    def configure(self, args):
+        self.opts = parse_args(args)
         demands = self.cli.demands
-        demands.sack_activation = True
+        # --by-inode loads the installed packages only if a file is replaced
+        demands.sack_activation = not self.opts.by_inode
 
-    def run(self, args):
-        opts = parse_args(args)
-        process_start = ProcessStart()
-        owning_pkg_fn = functools.partial(owning_package, self.base.sack)
-        owning_pkg_fn = memoize(owning_pkg_fn)
+    def run(self, _args):
+        opts = self.opts
+        if opts.jobs < 1:
+            raise dnf.exceptions.Error(_("--jobs has to be a positive number."))
 
-        stale_pids = set()
         uid = os.geteuid() if opts.useronly else None
-        for ofile in list_opened_files(uid):
-            pkg = owning_pkg_fn(ofile.presumed_name)
+        process_start = None if opts.by_inode else ProcessStart()
+        starts = {}
+        units = {}
+        ofiles = []
+        for (pid, start, pid_ofiles, unit) in scan_processes(
+                uid, process_start, opts.jobs, opts.services):
+            starts[pid] = start
+            units[pid] = unit
+            ofiles.extend(pid_ofiles)
+        if opts.by_inode:
+            stale_pids = self.replaced_pids(ofiles)
+        else:
+            stale_pids = self.updated_pids(ofiles, starts)
+
+        if opts.services:
+            for unit in sorted(set(units[pid] for pid in stale_pids
+                                   if units[pid] is not None)):
+                print(unit)
+            # processes outside of any unit are still listed one by one
+            stale_pids = set(pid for pid in stale_pids if units[pid] is None)
+        for pid in sorted(stale_pids):
+            try:
+                print_cmd(pid)
+            except EnvironmentError:
+                # the process has exited since the scan
+                continue
+
+    def updated_pids(self, ofiles, starts):
+        """Return pids using files of packages installed after they started."""
+        owners = owning_packages(
+            self.base.sack, (ofile.presumed_name for ofile in ofiles))
+        stale_pids = set()
+        for ofile in ofiles:
+            pkg = owners.get(ofile.presumed_name)
             if pkg is None:
                 continue
-            if pkg.installtime > process_start(ofile.pid):
+            if pkg.installtime > starts[ofile.pid]:
                 stale_pids.add(ofile.pid)
+        return stale_pids
 
-        for pid in sorted(stale_pids):
-            print_cmd(pid)
+    def replaced_pids(self, ofiles):
+        """Return pids using packaged files replaced on the disk.
+
+        Only the packages owning the replaced files are looked up, files not
+        owned by any package, like deleted temporary files, are ignored.
+
+        """
+        replaced = replaced_files(ofiles)
+        if not replaced:
+            return set()
+        self.base.fill_sack(load_system_repo=True, load_available_repos=False)
+        owners = owning_packages(
+            self.base.sack, (ofile.presumed_name for ofile in replaced))
+        return set(ofile.pid for ofile in replaced
+                   if ofile.presumed_name in owners)
@@ -17,22 +17,63 @@
 #
 
 from __future__ import absolute_import
+from __future__ import print_function
 from __future__ import unicode_literals
 from datetime import datetime
-from dnfpluginscore import _
+from dnfpluginscore import _, logger
 
 import argparse
+import bisect
+import collections
+import cProfile
 import dnf
 import dnf.cli
 import dnf.exceptions
+import dnf.i18n
+import dnf.pycomp
 import dnf.subject
+import dnf.util
 import dnfpluginscore
 import functools
+import gzip
+import hashlib
 import hawkey
+import heapq
+import json
+import multiprocessing
+import numbers
+import operator
+import os
 import re
+import shlex
+import shutil
+import stat
+import string
+import sys
+import tempfile
 import textwrap
+import time
+import zlib
+
+if dnf.pycomp.PY3:
+    from io import StringIO
+    import dbm
+    import socketserver
+else:
+    from StringIO import StringIO
+    import anydbm as dbm
+    import SocketServer as socketserver
+
+try:
+    import rpm
+except ImportError:
+    rpm = None
 
 QFORMAT_DEFAULT = '%{name}-%{epoch}:%{version}-%{release}.%{arch}'
+# where rpm keeps its database unless %_dbpath says otherwise
+RPMDB_PATH = '/var/lib/rpm'
+# indexes of every kind kept in the cache, one per set of repos and excludes
+INDEX_KEEP = 4
 # matches %[-][dd]{attr}
 QFORMAT_MATCH = re.compile(r'%([-\d]*?){([:\.\w]*?)}')
 
@@ -58,28 +99,83 @@ provides, requires, obsoletes, conflicts, sourcerpm
 description, summary, license, url
 """
 
+TIME_TAGS = frozenset(('buildtime', 'installtime'))
+INFO_TAGS = ('name', 'version', 'release', 'arch', 'size', 'license',
+             'sourcerpm', 'buildtime', 'packager', 'url', 'summary',
+             'description')
+OUTPUT_FORMATS = ('jsonl', 'csv', 'nul')
+# matches {0.attr} fields produced by rpm2py_format()
+FIELD_MATCH = re.compile(r'^0\.(\w+)$')
+# keys containing these can be more than just a package name
+NEVRA_CHARS = re.compile(r'[-.:/]')
+GLOB_CHARS = re.compile(r'[*?[]')
+# splits a capability into names, operators and versions
+DEP_TOKENS = re.compile(r'[^\s()<>=]+')
+RICH_DEP_KEYWORDS = frozenset(('and', 'or', 'if', 'else', 'with', 'without',
+                               'unless'))
+# options --from-file can list
+PATTERN_OPTS = {'-f': 'file', '--file': 'file',
+                '--whatprovides': 'whatprovides',
+                '--whatrequires': 'whatrequires'}
+# options acting on the files or the process of the server, which queries
+# sent to --serve can not use
+LOCAL_OPTS = (('cache', '--cache'), ('from_file', '--from-file'),
+              ('profile', '--profile'), ('timings', '--timings'),
+              ('timings_json', '--timings-json'))
+
 
 def build_format_fn(opts):
     if opts.queryinfo:
-        return info_format
+        return QueryFormatter(QUERY_INFO)
     elif opts.queryfilelist:
-        return filelist_format
+        return QueryFormatter('{0.files}')
     elif opts.querysourcerpm:
-        return sourcerpm_format
+        return QueryFormatter('{0.sourcerpm}')
+    else:
+        return QueryFormatter(rpm2py_format(opts.queryformat))
+
+
+def build_output_fn(opts):
+    """Return the function rendering packages for the --output format."""
+    if opts.output == 'jsonl':
+        return JsonFormatter(output_tags(opts))
+    elif opts.output == 'csv':
+        return CsvFormatter(output_tags(opts))
     else:
-        return rpm2py_format(opts.queryformat).format
+        return build_format_fn(opts)
 
 
-def info_format(pkg):
-    return QUERY_INFO.format(pkg)
+def filelists_needed(opts):
+    """Tell whether the query needs the filelists metadata of the repos.
 
+    Without filelists only the files listed in the primary metadata are
+    known, i.e. the ones commonly required like /etc/* or */bin/*.
 
-def filelist_format(pkg):
-    return pkg.files
+    """
+    if opts.serve or opts.queryfilelist or opts.file or opts.alldeps or \
+       opts.resolve or opts.tree:
+        return True
+    if any('/' in pattern for pattern in opts.whatprovides or []):
+        return True
+    if any('/' in key for key in opts.key):
+        return True
+    return 'files' in output_tags(opts)
 
 
-def sourcerpm_format(pkg):
-    return pkg.sourcerpm
+def output_tags(opts):
+    """Return tags included in --output records, in the order of output."""
+    if opts.queryinfo:
+        return list(INFO_TAGS)
+    elif opts.queryfilelist:
+        return ['files']
+    elif opts.querysourcerpm:
+        return ['sourcerpm']
+    tags = []
+    for _fill, tag in QFORMAT_MATCH.findall(opts.queryformat):
+        tag = tag.lower()
+        if tag not in tags:
+            tags.append(tag)
+    return tags
 
 
 def parse_arguments(args):
@@ -94,12 +190,19 @@ def parse_arguments(args):
                         help=argparse.SUPPRESS)
     parser.add_argument('--arch', metavar='ARCH',
                         help=_('show only results from this ARCH'))
-    parser.add_argument('-f', '--file', metavar='FILE',
-                        help=_('show only results that owns FILE'))
-    parser.add_argument('--whatprovides', metavar='REQ',
-                        help=_('show only results there provides REQ'))
-    parser.add_argument('--whatrequires', metavar='REQ',
-                        help=_('show only results there require REQ'))
+    parser.add_argument('-f', '--file', metavar='FILE', action='append',
+                        help=_('show only results that owns FILE, can be '
+                               'given more times'))
+    parser.add_argument('--whatprovides', metavar='REQ', action='append',
+                        help=_('show only results there provides REQ, can be '
+                               'given more times'))
+    parser.add_argument('--whatrequires', metavar='REQ', action='append',
+                        help=_('show only results there require REQ, can be '
+                               'given more times'))
+    parser.add_argument('--from-file', dest='from_file', metavar='LIST',
+                        help=_('read more --file, --whatprovides and '
+                               '--whatrequires options from LIST, one per '
+                               'line'))
     parser.add_argument('--whatrecommends', metavar='REQ',
                         help=_('show only results that recommend REQ'))
     parser.add_argument('--whatenhances', metavar='REQ',
@@ -115,10 +218,48 @@ def parse_arguments(args):
                                '--queryformat'))
     parser.add_argument('--resolve', action='store_true',
                         help=_('resolve capabilities to originating package(s)'))
+    parser.add_argument('--show-origin', dest='show_origin',
+                        action='store_true',
+                        help=_('show which capability resolved to which '
+                               'package with --resolve, or which pattern '
+                               'matched which package otherwise'))
     parser.add_argument("--tree", action="store_true",
                         help=_('show recursive tree for package(s)'))
+    parser.add_argument("--tree-depth", dest='tree_depth', metavar='N',
+                        type=int,
+                        help=_('show at most N levels of the --tree'))
     parser.add_argument('--srpm', action='store_true',
                         help=_('operate on corresponding source RPM'))
+    parser.add_argument('--stream', action='store_true',
+                        help=_('print results as soon as they are found '
+                               'instead of sorting them'))
+    parser.add_argument('--output', choices=OUTPUT_FORMATS,
+                        help=_('print one record per package in the given '
+                               'format, as soon as it is found'))
+    parser.add_argument('--since', metavar='TIMESTAMP', type=int,
+                        help=_('show only packages built after TIMESTAMP '
+                               '(seconds since the epoch)'))
+    parser.add_argument('--jobs', metavar='N', type=int, default=1,
+                        help=_('format the results in N processes'))
+    parser.add_argument('--timings', action='store_true',
+                        help=_('print time spent in the stages of the query'))
+    parser.add_argument('--timings-json', dest='timings_json', metavar='FILE',
+                        help=_('write time spent in the stages of the query '
+                               'to FILE as JSON'))
+    parser.add_argument('--profile', metavar='FILE',
+                        help=_('profile the query and dump the stats to FILE'))
+    parser.add_argument('--serve', metavar='SOCKET',
+                        help=_('load the packages once and answer queries '
+                               'sent to the SOCKET'))
+    parser.add_argument('--use-index', dest='use_index', action='store_true',
+                        help=_('answer queries from indexes kept in the '
+                               'cache directory'))
+    parser.add_argument('--cache', action='store_true',
+                        help=_('reuse the output of the same query while '
+                               'the metadata and the rpmdb do not change'))
+    parser.add_argument('--cache-size', dest='cache_size', metavar='MB',
+                        type=int, default=64,
+                        help=_('keep at most MB megabytes of cached outputs'))
 
     outform = parser.add_mutually_exclusive_group()
     outform.add_argument('-i', "--info", dest='queryinfo',
@@ -180,7 +321,122 @@ def parse_arguments(args):
         list_group.add_argument(switch, dest='list', action='store_const',
                                 const=list_arg, help=help_list[list_arg])
 
-    return parser.parse_args(args), parser
+    opts = parser.parse_args(args)
+    return opts, parser
+
+
+def read_patterns(opts, fn):
+    """Add --file, --whatprovides and --whatrequires options listed in fn.
+
+    Every line holds one option and its value, quoted like on a shell
+    command line. Empty lines and lines starting with # are skipped.
+
+    """
+    try:
+        with open(fn) as patterns:
+            lines = patterns.read().splitlines()
+    except EnvironmentError as e:
+        raise dnf.exceptions.Error(
+            _('Failed to read %s: %s') % (fn, e.strerror))
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        try:
+            words = shlex.split(line)
+        except ValueError as e:
+            raise dnf.exceptions.Error('%s:%d: %s' % (fn, lineno, e))
+        dest = PATTERN_OPTS.get(words[0])
+        if dest is None or len(words) != 2:
+            raise dnf.exceptions.Error(
+                _('%s:%d: expected one of --file, --whatprovides or '
+                  '--whatrequires with a value') % (fn, lineno))
+        values = getattr(opts, dest) or []
+        values.append(words[1])
+        setattr(opts, dest, values)
+
+
+def split_keys(keys):
+    """Split keys into plain names, name globs and other pkg-specs.
+
+    Only the other pkg-specs need to be resolved one by one, names and globs
+    can be matched by a single filter each.
+
+    """
+    names = []
+    globs = []
+    others = []
+    for key in keys:
+        if NEVRA_CHARS.search(key):
+            others.append(key)
+        elif GLOB_CHARS.search(key):
+            globs.append(key)
+        else:
+            names.append(key)
+    return names, globs, others
+
+
+def split_deps(sack, deps):
+    """Split capabilities into parsed exact ones and globs.
+
+    Exact capabilities are returned as (capability, Reldep) pairs. Those
+    hawkey can not parse are matched as globs.
+
+    """
+    exact = []
+    globs = []
+    for dep in deps:
+        if GLOB_CHARS.search(dep):
+            globs.append(dep)
+            continue
+        try:
+            exact.append((dep, hawkey.Reldep(sack, dep)))
+        except hawkey.ValueException:
+            globs.append(dep)
+    return exact, globs
+
+
+def format_pkg(fmt_fn, pkg):
+    try:
+        return fmt_fn(pkg)
+    except AttributeError as e:
+        # catch that the user has specified attributes
+        # there don't exist on the dnf Package object.
+        raise dnf.exceptions.Error(str(e))
+
+
+# packages and format function of the running parallel_format(), the forked
+# workers inherit them as they can not be pickled
+_FORMAT_JOB = None
+
+
+def format_shard(shard):
+    """Return sorted unique lines of the shard-th part of the packages."""
+    pkgs, fmt_fn, jobs = _FORMAT_JOB
+    size = (len(pkgs) + jobs - 1) // jobs
+    return sorted(set(format_pkg(fmt_fn, pkg)
+                      for pkg in pkgs[shard * size:(shard + 1) * size]))
+
+
+def parallel_format(pkgs, fmt_fn, jobs):
+    """Format pkgs in jobs processes, return the lines merged and sorted."""
+    global _FORMAT_JOB
+    try:
+        context = multiprocessing.get_context('fork')
+    except AttributeError:
+        # Python 2 always forks
+        context = multiprocessing
+    _FORMAT_JOB = (pkgs, fmt_fn, jobs)
+    pool = context.Pool(jobs)
+    try:
+        shards = pool.map(format_shard, range(jobs))
+    finally:
+        pool.terminate()
+        _FORMAT_JOB = None
+    previous = None
+    for line in heapq.merge(*shards):
+        if line != previous:
+            previous = line
+            yield line
 
 
 def rpm2py_format(queryformat):
@@ -202,6 +458,548 @@ def rpm2py_format(queryformat):
     return fmt
 
 
+def tag_getter(tag):
+    """Return a function rendering the tag of a package to a string."""
+    getter = operator.attrgetter(tag)
+    ucd = dnf.i18n.ucd
+    if tag in TIME_TAGS:
+        timestamp = PackageWrapper._get_timestamp
+        return lambda pkg: timestamp(getter(pkg))
+
+    def render(pkg):
+        val = getter(pkg)
+        if isinstance(val, list):
+            return '\n'.join(sorted([ucd(item) for item in val]))
+        return ucd(val)
+    return render
+
+
+def tag_value_getter(tag):
+    """Return a function returning the tag of a package as a JSON value."""
+    getter = operator.attrgetter(tag)
+    ucd = dnf.i18n.ucd
+
+    def value(pkg):
+        val = getter(pkg)
+        if isinstance(val, list):
+            return sorted([ucd(item) for item in val])
+        if val is None or isinstance(val, numbers.Number):
+            return val
+        return ucd(val)
+    return value
+
+
+def csv_field(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        value = '\n'.join(value)
+    value = dnf.i18n.ucd(value)
+    if any(char in value for char in ',"\r\n'):
+        return '"%s"' % value.replace('"', '""')
+    return value
+
+
+def csv_row(values):
+    return ','.join([csv_field(value) for value in values])
+
+
+class QueryFormatter(object):
+
+    """Render packages using a .format() string compiled only once.
+
+    Every field of the format is bound to a getter specialized for its tag, so
+    rendering a package does not go through PackageWrapper. Formats using
+    anything else than plain attribute fields fall back to PackageWrapper.
+
+    """
+
+    def __init__(self, fmt):
+        self._fmt = fmt
+        self._parts = []
+        for literal, field, spec, conversion in string.Formatter().parse(fmt):
+            if field is None:
+                self._parts.append((literal, None, None))
+                continue
+            match = FIELD_MATCH.match(field)
+            if match is None or conversion:
+                self._parts = None
+                break
+            self._parts.append((literal, tag_getter(match.group(1)), spec))
+
+    def __call__(self, pkg):
+        if self._parts is None:
+            return self._fmt.format(PackageWrapper(pkg))
+        chunks = []
+        for literal, getter, spec in self._parts:
+            chunks.append(literal)
+            if getter is not None:
+                chunks.append(format(getter(pkg), spec) if spec else getter(pkg))
+        return ''.join(chunks)
+
+
+def dep_names(dep):
+    """Return names of packages or files a capability string refers to."""
+    if not dep.startswith('('):
+        return DEP_TOKENS.findall(dep)[:1]
+    # rich dependency, versions are indexed too but they do no harm
+    return [token for token in DEP_TOKENS.findall(dep)
+            if token not in RICH_DEP_KEYWORDS]
+
+
+def index_path(cachedir, prefix, fingerprint, build):
+    """Return the path of the index for fingerprint, build it if missing.
+
+    build is called with the path to write the new index to. Only the
+    INDEX_KEEP most recently used indexes of the same prefix are kept, so that
+    runs alternating between a few sets of repos do not rebuild them.
+
+    """
+    topdir = os.path.join(cachedir, 'repoquery')
+    indexdir = os.path.join(topdir, prefix + fingerprint)
+    path = os.path.join(indexdir, 'index')
+    if os.path.isdir(indexdir):
+        try:
+            os.utime(indexdir, None)
+        except OSError:
+            pass
+        return path
+    dnf.util.ensure_dir(topdir)
+    tmpdir = tempfile.mkdtemp(dir=topdir)
+    try:
+        build(os.path.join(tmpdir, 'index'))
+        os.rename(tmpdir, indexdir)
+    except OSError:
+        # another process has just built the same index
+        if not os.path.isdir(indexdir):
+            raise
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    prune_indexes(topdir, prefix, INDEX_KEEP)
+    return path
+
+
+def prune_indexes(topdir, prefix, keep):
+    """Remove all but the keep most recently used indexes of prefix."""
+    indexes = []
+    for fn in os.listdir(topdir):
+        if fn.startswith(prefix):
+            indexdir = os.path.join(topdir, fn)
+            try:
+                indexes.append((os.stat(indexdir).st_mtime, indexdir))
+            except OSError:
+                continue
+    for _mtime, indexdir in sorted(indexes, reverse=True)[keep:]:
+        shutil.rmtree(indexdir, ignore_errors=True)
+
+
+class RevDepIndex(object):
+
+    """On-disk index of capability names to names of packages using them.
+
+    The index only narrows the query down to candidate packages, the exact
+    filter is still applied on the candidates afterwards. Every index is
+    stored under the fingerprint of the metadata it was built from, a change
+    of the metadata makes a new index to be built.
+
+    """
+
+    DEPS = ('enhances', 'recommends', 'requires', 'suggests', 'supplements')
+    DIR_PREFIX = 'revdeps-'
+
+    def __init__(self, db):
+        self._db = db
+
+    @staticmethod
+    def _key(dep, name):
+        return ('%s:%s' % (dep, name)).encode('utf-8')
+
+    @classmethod
+    def build(cls, sack, path):
+        index = {}
+        for pkg in sack.query().run():
+            for dep in cls.DEPS:
+                for reldep in getattr(pkg, dep):
+                    for name in dep_names(str(reldep)):
+                        index.setdefault(cls._key(dep, name), set()).add(
+                            pkg.name)
+        db = dbm.open(path, 'n')
+        try:
+            for key, names in index.items():
+                db[key] = '\n'.join(sorted(names)).encode('utf-8')
+        finally:
+            db.close()
+
+    @classmethod
+    def open(cls, sack, cachedir, fingerprint):
+        """Open the index for fingerprint, build it first if it is missing."""
+        path = index_path(cachedir, cls.DIR_PREFIX, fingerprint,
+                          lambda path: cls.build(sack, path))
+        return cls(dbm.open(path, 'r'))
+
+    def close(self):
+        self._db.close()
+
+    def lookup(self, dep, pattern):
+        """Return names of packages possibly matching pattern for dep.
+
+        None is returned when the index can not answer the pattern.
+
+        """
+        if GLOB_CHARS.search(pattern) or pattern.startswith('('):
+            return None
+        names = dep_names(pattern)
+        if not names:
+            return None
+        try:
+            value = self._db[self._key(dep, names[0])]
+        except KeyError:
+            return []
+        return value.decode('utf-8').split('\n')
+
+
+class RecordFormatter(object):
+
+    """Render packages as records of the given tags."""
+
+    def __init__(self, tags):
+        self.tags = tags
+        self._getters = [(tag, tag_value_getter(tag)) for tag in tags]
+
+    def record(self, pkg):
+        return collections.OrderedDict(
+            [(tag, getter(pkg)) for tag, getter in self._getters])
+
+
+class JsonFormatter(RecordFormatter):
+
+    """Render every package as a JSON object on a single line."""
+
+    def __call__(self, pkg):
+        return json.dumps(self.record(pkg))
+
+
+class CsvFormatter(RecordFormatter):
+
+    """Render every package as a CSV row, list values are one per line."""
+
+    def header(self):
+        return csv_row(self.tags)
+
+    def __call__(self, pkg):
+        return csv_row(self.record(pkg).values())
+
+
+class BuildtimeIndex(object):
+
+    """On-disk list of package names sorted by their buildtime.
+
+    Packages built after a given time are found by a binary search, the
+    names of the packages after it are the candidates for the query.
+
+    """
+
+    DIR_PREFIX = 'buildtimes-'
+
+    def __init__(self, buildtimes, names):
+        self._buildtimes = buildtimes
+        self._names = names
+
+    @staticmethod
+    def build(sack, path):
+        entries = sorted((pkg.buildtime, pkg.name)
+                         for pkg in sack.query().run())
+        with open(path, 'w') as index:
+            index.write(json.dumps([[buildtime for buildtime, _name in entries],
+                                    [name for _buildtime, name in entries]]))
+
+    @classmethod
+    def open(cls, sack, cachedir, fingerprint):
+        """Open the index for fingerprint, build it first if it is missing."""
+        path = index_path(cachedir, cls.DIR_PREFIX, fingerprint,
+                          lambda path: cls.build(sack, path))
+        with open(path) as index:
+            return cls(*json.load(index))
+
+    def names_since(self, timestamp):
+        """Return names of packages built after timestamp."""
+        start = bisect.bisect_right(self._buildtimes, timestamp)
+        return set(self._names[start:])
+
+
+def rpmdb_cookie(installroot):
+    """Return a string changing with every change of the rpmdb.
+
+    Only the files of the rpmdb are stat'ed, the rpmdb is not opened.
+
+    """
+    dbpath = RPMDB_PATH
+    if rpm is not None:
+        macro = rpm.expandMacro('%_dbpath')
+        if not macro.startswith('%'):
+            dbpath = macro
+    dbpath = os.path.join(installroot, dbpath.lstrip('/'))
+    try:
+        fns = sorted(os.listdir(dbpath))
+    except OSError:
+        return ''
+    cookie = []
+    for fn in fns:
+        try:
+            st = os.stat(os.path.join(dbpath, fn))
+        except OSError:
+            continue
+        cookie.append('%s:%d:%d:%r' % (fn, st.st_ino, st.st_size, st.st_mtime))
+    return ' '.join(cookie)
+
+
+class ResultCache(object):
+
+    """Compressed outputs of queries kept in the cache directory.
+
+    Every output is stored in a file named by the key of its query. A hit
+    touches the file, when the cache grows over max_size the least recently
+    used outputs are removed first.
+
+    """
+
+    # configuration changing the output of a query, of dnf.conf and the repos
+    CONF_OPTS = ('disable_excludes', 'exclude', 'excludepkgs', 'include',
+                 'includepkgs', 'installonlypkgs')
+    REPO_OPTS = ('exclude', 'excludepkgs', 'include', 'includepkgs')
+    # options not changing the output of a query
+    IGNORED_OPTS = frozenset(('cache', 'cache_size', 'jobs', 'profile',
+                              'timings', 'timings_json', 'use_index'))
+    SUFFIX = '.gz'
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    @classmethod
+    def key(cls, opts, sources):
+        """Return the key of the query of opts run on sources.
+
+        sources describe everything else the output depends on: the checksums
+        of the metadata, the rpmdb cookie and the configuration.
+
+        """
+        args = dict((name, value) for name, value in vars(opts).items()
+                    if name not in cls.IGNORED_OPTS)
+        data = json.dumps([args, sources], sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def conf_values(conf, names):
+        """Return the values of the names options of conf, comparable in a key.
+
+        Options the DNF version does not have are None.
+
+        """
+        values = []
+        for name in names:
+            value = getattr(conf, name, None)
+            if isinstance(value, (list, tuple, set, frozenset)):
+                value = sorted(dnf.i18n.ucd(item) for item in value)
+            elif value is not None:
+                value = dnf.i18n.ucd(value)
+            values.append([name, value])
+        return values
+
+    def _fn(self, key):
+        return os.path.join(self.path, key + self.SUFFIX)
+
+    def get(self, key):
+        """Return the cached output for key, None if there is none."""
+        fn = self._fn(key)
+        try:
+            with gzip.open(fn, 'rb') as cached:
+                output = cached.read().decode('utf-8')
+            os.utime(fn, None)
+        except (EnvironmentError, EOFError, zlib.error):
+            return None
+        return output
+
+    def put(self, key, output):
+        dnf.util.ensure_dir(self.path)
+        (fd, tmp_fn) = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                with gzip.GzipFile(fileobj=tmp_file, mode='wb') as cached:
+                    cached.write(output.encode('utf-8'))
+            os.rename(tmp_fn, self._fn(key))
+        except EnvironmentError:
+            os.unlink(tmp_fn)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used outputs over max_size."""
+        entries = []
+        for fn in os.listdir(self.path):
+            if not fn.endswith(self.SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, fn))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fn))
+        total = sum(size for _mtime, size, _fn in entries)
+        for _mtime, size, fn in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.path, fn))
+            except OSError:
+                pass
+            total -= size
+
+
+class StageTimer(object):
+
+    """Measure wall time, CPU time and result size of consecutive stages.
+
+    Every stage lasts from the previous mark, or from the creation of the
+    timer, to its own mark. Queries are lazy, a query marking the end of a
+    stage is evaluated within that stage.
+
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.stages = []
+        self._last = self._now()
+
+    @staticmethod
+    def _now():
+        times = os.times()
+        return time.time(), times[0] + times[1]
+
+    def mark(self, name, result=None):
+        if not self.enabled:
+            return
+        if result is not None and hasattr(result, 'run'):
+            result = result.run()
+        now = self._now()
+        self.stages.append(collections.OrderedDict([
+            ('stage', name),
+            ('wall', now[0] - self._last[0]),
+            ('cpu', now[1] - self._last[1]),
+            ('size', None if result is None else len(result))]))
+        # do not count the size computation in the next stage
+        self._last = self._now()
+
+    def report(self):
+        print('%-12s %10s %10s %10s' % (_('stage'), _('wall [s]'),
+                                        _('cpu [s]'), _('size')),
+              file=sys.stderr)
+        for stage in self.stages:
+            size = '-' if stage['size'] is None else stage['size']
+            print('%-12s %10.3f %10.3f %10s' % (
+                stage['stage'], stage['wall'], stage['cpu'], size),
+                file=sys.stderr)
+
+    def dump(self, fn):
+        with open(fn, 'w') as timings:
+            timings.write(json.dumps(self.stages, indent=2))
+
+
+class SortedOutput(object):
+
+    """Collect unique output lines and print them sorted at the end."""
+
+    def __init__(self):
+        self._lines = set()
+
+    def add(self, line):
+        self._lines.add(line)
+
+    def close(self):
+        for line in sorted(self._lines):
+            print(line)
+
+
+class StreamOutput(object):
+
+    """Print unique output lines in batches as soon as they are produced.
+
+    Only SHA-1 digests of the already printed lines are kept in memory, so the
+    memory use does not grow with the length of the lines.
+
+    """
+
+    BATCH_SIZE = 1024
+
+    def __init__(self, batch_size=BATCH_SIZE, terminator='\n'):
+        self._batch = []
+        self._batch_size = batch_size
+        self._seen = set()
+        self._terminator = terminator
+
+    def add(self, line):
+        key = hashlib.sha1(dnf.i18n.ucd(line).encode('utf-8')).digest()
+        if key in self._seen:
+            return
+        self._seen.add(key)
+        self._batch.append(line)
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            print(self._terminator.join(self._batch), end=self._terminator)
+            sys.stdout.flush()
+            self._batch = []
+
+    def close(self):
+        self.flush()
+
+
+def query_response(output, error):
+    return collections.OrderedDict([('output', output), ('error', error)])
+
+
+class QueryRequestHandler(socketserver.StreamRequestHandler):
+
+    """Answer queries sent over a connection, one query per line.
+
+    A query is a line of repoquery arguments quoted like on a shell command
+    line. Every query gets one JSON object in response, again on a single
+    line, holding the output and the error message of the query.
+
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode('utf-8').strip()
+            if not line:
+                continue
+            try:
+                args = shlex.split(line)
+            except ValueError as e:
+                response = query_response('', str(e))
+            else:
+                response = self.server.command.answer(args)
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class QueryServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+
+    """Serve queries on a Unix socket, every connection in its own process.
+
+    The forked processes share the already loaded sack with the server, so
+    connections are handled concurrently without loading the metadata again.
+    Anything a connection builds is lost when its process exits, see
+    RepoQueryCommand.prepare_serve().
+
+    """
+
+    def __init__(self, path, command):
+        socketserver.UnixStreamServer.__init__(self, path, QueryRequestHandler)
+        self.command = command
+
+
 class RepoQuery(dnf.Plugin):
 
     name = 'Query'
@@ -221,6 +1019,21 @@ class RepoQueryCommand(dnf.cli.Command):
     summary = _('search for packages matching keyword')
     usage = _('[OPTIONS] [KEYWORDS]')
 
+    def __init__(self, cli):
+        super(RepoQueryCommand, self).__init__(cli)
+        self._alldeps_cache = {}
+        self._fingerprint = None
+        self._indexes = {}
+        self.timer = StageTimer(False)
+        self._srpm_index = None
+        self._installonly = None
+        self._result_cache = None
+        self._cache_key = None
+        self._cached_output = None
+        self._providers_cache = {}
+        self._tree_cache = {}
+        self._serve_srpm = False
+
     @staticmethod
     def by_dep(sack, pattern, query, dep):
         try:
@@ -240,8 +1053,128 @@ class RepoQueryCommand(dnf.cli.Command):
             query = query.filter(arch=archs)
         return query
 
+    def by_revdep(self, query, dep, patterns):
+        """Filter packages having dep matching any of patterns.
+
+        The index narrows the query down only if it can answer all the
+        patterns.
+
+        """
+        index = self.open_index(RevDepIndex) if self.opts.use_index else None
+        if index is not None:
+            names = set()
+            for pattern in patterns:
+                found = index.lookup(dep, pattern)
+                if found is None:
+                    break
+                names.update(found)
+            else:
+                if not names:
+                    return query.filter(empty=True)
+                query = query.filter(name=list(names))
+        if dep == 'requires':
+            return query.filter(requires__glob=patterns)
+        return self.by_dep(self.base.sack, patterns[0], query, dep)
+
+    def by_buildtime(self, query, since):
+        """Filter packages built after the since timestamp."""
+        index = self.open_index(BuildtimeIndex) if self.opts.use_index else None
+        if index is not None:
+            names = list(index.names_since(since))
+            if not names:
+                return query.filter(empty=True)
+            query = query.filter(name=names)
+        return query.filter(
+            pkg=[pkg for pkg in query.run() if pkg.buildtime > since])
+
+    def by_srpm(self, query):
+        """Return source packages of the packages in query."""
+        index = self.srpm_index()
+        pkgs = []
+        for sourcerpm in set(pkg.sourcerpm for pkg in query.run()):
+            pkgs.extend(index.get(sourcerpm, []))
+        return self.base.sack.query().filter(pkg=pkgs)
+
+    def srpm_index(self):
+        """Return a dict of source RPM file names to source packages."""
+        if self._srpm_index is None:
+            self._srpm_index = {}
+            for pkg in self.base.sack.query().filter(arch='src').run():
+                sourcerpm = '%s-%s-%s.src.rpm' % (
+                    pkg.name, pkg.version, pkg.release)
+                self._srpm_index.setdefault(sourcerpm, []).append(pkg)
+        return self._srpm_index
+
+    def metadata_fingerprint(self):
+        """Return a checksum identifying the loaded packages.
+
+        Besides the metadata and the rpmdb, the packages in the sack depend on
+        the excludes and includes of the configuration and the repos.
+
+        """
+        chksum = hashlib.sha256()
+        for repo in sorted(self.base.repos.iter_enabled(), key=lambda r: r.id):
+            if repo.metadata is None:
+                return None
+            with open(repo.metadata.repomd_fn, 'rb') as repomd:
+                chksum.update(repo.id.encode('utf-8'))
+                chksum.update(repomd.read())
+            values = ResultCache.conf_values(repo, ResultCache.REPO_OPTS)
+            chksum.update(json.dumps(values).encode('utf-8'))
+        values = ResultCache.conf_values(self.base.conf, ResultCache.CONF_OPTS)
+        chksum.update(json.dumps(values).encode('utf-8'))
+        rpmdb = self.base.sack.rpmdb_version(self.base.yumdb)
+        chksum.update(str(rpmdb).encode('utf-8'))
+        return chksum.hexdigest()
+
+    def cache_sources(self):
+        """Return what the output depends on besides the options.
+
+        Besides the configuration, only the cached metadata and the files of
+        the rpmdb are read, so that a hit in the result cache does not load
+        the sack. None is returned if the metadata is missing or expired and
+        will be downloaded.
+
+        """
+        repos = []
+        for repo in sorted(self.base.repos.iter_enabled(), key=lambda r: r.id):
+            has_cache, expire_in = repo.metadata_expire_in()
+            if not has_cache or (expire_in is not None and expire_in <= 0):
+                return None
+            repomd_fn = os.path.join(repo.cachedir, 'repodata', 'repomd.xml')
+            try:
+                with open(repomd_fn, 'rb') as repomd:
+                    repos.append(
+                        [repo.id, hashlib.sha256(repomd.read()).hexdigest(),
+                         ResultCache.conf_values(repo, ResultCache.REPO_OPTS)])
+            except EnvironmentError:
+                return None
+        conf = self.base.conf
+        return {'repos': repos,
+                'rpmdb': rpmdb_cookie(conf.installroot),
+                'installroot': conf.installroot,
+                'substitutions': sorted(conf.substitutions.items()),
+                'conf': ResultCache.conf_values(conf, ResultCache.CONF_OPTS)}
+
+    def open_index(self, cls):
+        """Open the cls index for the loaded metadata, None if that fails."""
+        if cls not in self._indexes:
+            self._indexes[cls] = None
+            if self._fingerprint is None:
+                self._fingerprint = self.metadata_fingerprint()
+            if self._fingerprint is not None:
+                try:
+                    self._indexes[cls] = cls.open(
+                        self.base.sack, self.base.conf.cachedir,
+                        self._fingerprint)
+                except (EnvironmentError, ValueError, dbm.error) as e:
+                    logger.warning(_('Failed to use the index: %s'), e)
+        return self._indexes[cls]
+
     def configure(self, args):
         (self.opts, self.parser) = parse_arguments(args)
+        if self.opts.from_file:
+            read_patterns(self.opts, self.opts.from_file)
         demands = self.cli.demands
 
         if self.opts.help_cmd or self.opts.querytags:
@@ -250,32 +1183,201 @@ class RepoQueryCommand(dnf.cli.Command):
         if self.opts.srpm:
             dnfpluginscore.lib.enable_source_repos(self.base.repos)
 
-        if self.opts.pkgfilter != "installonly" and \
-           self.opts.list != "installed":
+        # only DNF versions having optional metadata types can skip filelists
+        types = getattr(self.base.conf, 'optional_metadata_types', None)
+        if types is not None:
+            types = [md_type for md_type in types if md_type != 'filelists']
+            if filelists_needed(self.opts):
+                types.append('filelists')
+            self.base.conf.optional_metadata_types = types
+
+        if self.opts.serve or (
+                self.opts.pkgfilter not in ("installonly", "unsatisfied") and
+                self.opts.list != "installed"):
             demands.available_repos = True
 
         demands.sack_activation = True
+        # the first stage is loading of the sack, done before run()
+        self.timer = StageTimer(
+            bool(self.opts.timings or self.opts.timings_json))
+
+        # --recent depends on the current time, the other queries do not
+        if self.opts.cache and not (self.opts.serve or self.opts.profile or
+                                    self.opts.list == 'recent'):
+            self._result_cache = ResultCache(
+                os.path.join(self.base.conf.cachedir, 'repoquery', 'results'),
+                self.opts.cache_size * 1024 * 1024)
+            sources = self.cache_sources()
+            if sources is not None:
+                self._cache_key = ResultCache.key(self.opts, sources)
+                self._cached_output = self._result_cache.get(self._cache_key)
+            if self._cached_output is not None:
+                demands.available_repos = False
+                demands.sack_activation = False
 
     def by_all_deps(self, name, query):
-        defaultquery = query.filter(name=name)
-        allpkgs = set()
-        requiresquery = query.filter(requires__glob=name)
-        for reqpkg in requiresquery.run():
-            allpkgs.add(reqpkg)
-        for pkg in defaultquery.run():
-            for provide in pkg.provides:
-                providequery = query.filter(requires=provide)
-                for needsprovidepkg in providequery.run():
-                    allpkgs.add(needsprovidepkg)
+        """Return packages requiring name or any provide or file of name.
+
+        Results are cached per name, --tree --alldeps asks again for every
+        node of the tree.
+
+        """
+        cached = self._alldeps_cache.get(name)
+        if cached is not None and cached[0] is query:
+            return cached[1]
+        deps = []
+        fnames = []
+        for pkg in query.filter(name=name).run():
+            deps.extend(pkg.provides)
+            fnames.extend(pkg.files)
+        allpkgs = query.filter(requires__glob=name).run()
+        if deps:
+            allpkgs += query.filter(requires=deps).run()
+        if fnames:
+            # hawkey turns the paths into reldeps itself
+            allpkgs += query.filter(requires=fnames).run()
         alldepsquery = query.filter(pkg=allpkgs)
+        self._alldeps_cache[name] = (query, alldepsquery)
         return alldepsquery
 
+    def by_keys(self, keys):
+        sack = self.base.sack
+        names, globs, others = split_keys(keys)
+        pkgs = []
+        if names:
+            pkgs += sack.query().filter(hawkey.ICASE, name=names).run()
+        if globs:
+            pkgs += sack.query().filter(hawkey.ICASE, name__glob=globs).run()
+        for key in others:
+            q = dnf.subject.Subject(key, ignore_case=True).get_best_query(
+                sack, with_provides=False)
+            pkgs += q.run()
+        return sack.query().filter(pkg=pkgs)
+
     def installonly(self, q):
-            installonly = q.installed().filter(
-                provides__glob=self.base.conf.installonlypkgs)
-            return installonly
+        if self._installonly is None:
+            self._installonly = self.base.sack.query().installed().filter(
+                provides__glob=self.base.conf.installonlypkgs).run()
+        return q.filter(pkg=self._installonly)
+
+    def answer(self, args):
+        """Run a query for args, return its output and error message."""
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        error = None
+        try:
+            self.opts, self.parser = parse_arguments(args)
+            self.timer = StageTimer(False)
+            if self.opts.serve:
+                raise dnf.exceptions.Error(_("--serve can not be nested."))
+            for name, switch in LOCAL_OPTS:
+                if getattr(self.opts, name):
+                    raise dnf.exceptions.Error(
+                        _("%s can not be used in queries sent to --serve.")
+                        % switch)
+            if self.opts.srpm and not self._serve_srpm:
+                raise dnf.exceptions.Error(
+                    _("--srpm needs --serve started with --srpm."))
+            self._alldeps_cache = {}
+            self.run_query()
+        except dnf.exceptions.Error as e:
+            error = str(e)
+        except Exception as e:
+            # one failed query must not take the connection down with it
+            logger.exception(_('Failed to answer query: %s'), ' '.join(args))
+            error = _('Internal error: %s') % e
+        finally:
+            output = sys.stdout.getvalue()
+            sys.stdout = stdout
+        return query_response(output, error)
+
+    def prepare_serve(self):
+        """Build what queries reuse before the server forks for connections.
+
+        Every connection is answered in a forked process, which inherits
+        whatever is built here and discards what it builds itself.
+
+        """
+        if self.opts.srpm:
+            self.srpm_index()
+        self.installonly(self.base.sack.query())
+        self._fingerprint = self.metadata_fingerprint()
+        if self.opts.use_index:
+            self.open_index(BuildtimeIndex)
+            # a dbm handle can not be shared by processes, the connections
+            # open the index built here again
+            index = self.open_index(RevDepIndex)
+            if index is not None:
+                index.close()
+            del self._indexes[RevDepIndex]
+
+    def serve(self, path):
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                # left behind by a server that did not exit cleanly
+                os.unlink(path)
+        except OSError:
+            pass
+        self._serve_srpm = self.opts.srpm
+        self.prepare_serve()
+        # only the user running the server can connect to the socket
+        umask = os.umask(0o077)
+        try:
+            server = QueryServer(path, self)
+        finally:
+            os.umask(umask)
+        logger.info(_('Answering queries on %s.'), path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(path)
 
     def run(self, args):
+        self.timer.mark('load')
+        if self._cached_output is not None:
+            sys.stdout.write(self._cached_output)
+        elif self._result_cache is not None:
+            self.run_cached()
+        elif self.opts.serve and not self.opts.help_cmd:
+            self.serve(self.opts.serve)
+        elif self.opts.profile:
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(self.run_query)
+            finally:
+                profiler.dump_stats(self.opts.profile)
+        else:
+            self.run_query()
+        if self.opts.timings:
+            self.timer.report()
+        if self.opts.timings_json:
+            self.timer.dump(self.opts.timings_json)
+
+    def run_cached(self):
+        """Run the query and store its output in the result cache."""
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.run_query()
+        finally:
+            output = sys.stdout.getvalue()
+            sys.stdout = stdout
+            sys.stdout.write(output)
+        if self._cache_key is None:
+            # the metadata has been downloaded while loading the sack
+            sources = self.cache_sources()
+            if sources is None:
+                return
+            self._cache_key = ResultCache.key(self.opts, sources)
+        try:
+            self._result_cache.put(self._cache_key, output)
+        except EnvironmentError as e:
+            logger.warning(_('Failed to cache the output: %s'), e)
+
+    def run_query(self):
         if self.opts.help_cmd:
             print(self.parser.format_help())
             return
@@ -285,18 +1387,38 @@ class RepoQueryCommand(dnf.cli.Command):
             print(QUERY_TAGS)
             return
 
+        if self.opts.output and \
+           (self.opts.tree or (self.opts.packageatr and not self.opts.resolve)):
+            raise dnf.exceptions.Error(
+                _("--output can not be used with --tree, nor with --requires "
+                  "and the other capability switches unless --resolve is "
+                  "given."))
+        if self.opts.tree_depth is not None and not self.opts.tree:
+            raise dnf.exceptions.Error(_("--tree-depth requires --tree."))
+        if self.opts.jobs < 1:
+            raise dnf.exceptions.Error(_("--jobs has to be a positive number."))
+        if self.opts.jobs > 1 and (self.opts.stream or self.opts.output):
+            # the pool returns the lines only after all of them are formatted
+            raise dnf.exceptions.Error(
+                _("--jobs can not be used with --stream or --output."))
+        if self.opts.show_origin and (
+                self.opts.output or not (self.opts.resolve or (
+                    self.pattern_matchers() and not self.opts.tree and
+                    not self.opts.packageatr))):
+            raise dnf.exceptions.Error(
+                _("--show-origin requires --resolve, or --file, "
+                  "--whatprovides or --whatrequires without --tree and the "
+                  "capability switches, and can not be used with --output."))
+
         q = self.base.sack.query()
 
         if self.opts.key:
-            pkgs = []
-            for key in self.opts.key:
-                q = dnf.subject.Subject(key, ignore_case=True).get_best_query(
-                    self.base.sack, with_provides=False)
-                pkgs += q.run()
-            q = self.base.sack.query().filter(pkg=pkgs)
+            q = self.by_keys(self.opts.key)
+        self.timer.mark('keys', q)
 
         if self.opts.list == "recent":
-            q.recent(self.base.conf.recent)
+            q = self.by_buildtime(
+                q, time.time() - self.base.conf.recent * 24 * 60 * 60)
         elif self.opts.list == "autoremove":
             q = q.unneeded(self.base.sack, self.base.yumdb)
         elif self.opts.list:
@@ -309,56 +1431,49 @@ class RepoQueryCommand(dnf.cli.Command):
         elif self.opts.pkgfilter == "installonly":
             q = self.installonly(q)
         elif self.opts.pkgfilter == "unsatisfied":
-            rpmdb = dnf.sack.rpmdb_sack(self.base)
-            goal = dnf.goal.Goal(rpmdb)
-            solved = goal.run(verify=True)
-            if not solved:
-                for msg in goal.problems:
-                    print(msg)
+            self.show_unsatisfied(q)
+            self.timer.mark('unsatisfied')
             return
-        elif self.opts.pkgfilter == "unsatisfied":
-            # do not show packages from @System repo
-            q = q.available()
+
+        if self.opts.since is not None:
+            q = self.by_buildtime(q, self.opts.since)
 
         # filter repo and arch
         q = self.filter_repo_arch(self.opts, q)
         orquery = q
+        self.timer.mark('lists', q)
 
+        # every filter matches all its patterns at once
         if self.opts.file:
             q = q.filter(file=self.opts.file)
         if self.opts.whatprovides:
-            q = q.filter(provides__glob=[self.opts.whatprovides])
+            q = q.filter(provides__glob=self.opts.whatprovides)
         if self.opts.alldeps:
             if not self.opts.whatrequires:
                 raise dnf.exceptions.Error(
                     _("--alldeps requires --whatrequires option.\n"
                       "usage: dnf repoquery [--whatrequires] [key] [--alldeps]\n\n"))
-            q = self.by_all_deps(self.opts.whatrequires, q)
+            pkgs = []
+            for name in self.opts.whatrequires:
+                pkgs += self.by_all_deps(name, q).run()
+            q = q.filter(pkg=pkgs)
         elif self.opts.whatrequires:
-            q = q.filter(requires__glob=self.opts.whatrequires)
+            q = self.by_revdep(q, 'requires', self.opts.whatrequires)
         if self.opts.whatrecommends:
-            q = self.by_dep(self.base.sack, self.opts.whatrecommends, q,
-                            'recommends')
+            q = self.by_revdep(q, 'recommends', [self.opts.whatrecommends])
         if self.opts.whatenhances:
-            q = self.by_dep(self.base.sack, self.opts.whatenhances, q,
-                            'enhances')
+            q = self.by_revdep(q, 'enhances', [self.opts.whatenhances])
         if self.opts.whatsupplements:
-            q = self.by_dep(self.base.sack, self.opts.whatsupplements, q,
-                            'supplements')
+            q = self.by_revdep(q, 'supplements', [self.opts.whatsupplements])
         if self.opts.whatsuggests:
-            q = self.by_dep(self.base.sack, self.opts.whatsuggests, q,
-                            'suggests')
+            q = self.by_revdep(q, 'suggests', [self.opts.whatsuggests])
         if self.opts.latest_limit:
             q = q.latest(self.opts.latest_limit)
+        self.timer.mark('filters', q)
         if self.opts.srpm:
-            pkg_list = []
-            for pkg in q:
-                pkg = pkg.sourcerpm
-                if (pkg is not None):
-                    tmp_query = self.base.sack.query().filter(nevra=pkg[:-4])
-                    pkg_list += tmp_query.run()
-            q = self.base.sack.query().filter(pkg=pkg_list)
-        fmt_fn = build_format_fn(self.opts)
+            q = self.by_srpm(q)
+            self.timer.mark('srpm', q)
+        fmt_fn = build_output_fn(self.opts)
         if self.opts.tree:
             if not self.opts.whatrequires and not self.opts.packageatr:
                 raise dnf.exceptions.Error(
@@ -366,42 +1481,193 @@ class RepoQueryCommand(dnf.cli.Command):
                         "--requires|--conflicts|--obsoletes|--enhances|--suggest|"
                         "--provides|--suplements|--recommends] [key] [--tree]\n\n"
                         "description:\n  For the given packages print a tree of the packages."))
+            if self.opts.tree_depth is not None and self.opts.tree_depth < 1:
+                raise dnf.exceptions.Error(
+                    _("--tree-depth has to be a positive number."))
             self.tree_seed(q, orquery, self.opts)
+            self.timer.mark('tree')
             return
 
-        pkgs = set()
-        if self.opts.packageatr:
-            for pkg in q.run():
-                rels = getattr(pkg, self.opts.packageatr)
-                for rel in rels:
-                    pkgs.add(str(rel))
+        if self.opts.output == 'nul':
+            out = StreamOutput(terminator='\0')
+        elif self.opts.output or self.opts.stream:
+            out = StreamOutput()
         else:
-            for pkg in q.run():
-                po = PackageWrapper(pkg)
-                try:
-                    pkgs.add(fmt_fn(po))
-                except AttributeError as e:
-                    # catch that the user has specified attributes
-                    # there don't exist on the dnf Package object.
-                    raise dnf.exceptions.Error(str(e))
+            out = SortedOutput()
+        if self.opts.output == 'csv':
+            print(fmt_fn.header())
         if self.opts.resolve:
             # find the providing packages and show them
-            query = self.filter_repo_arch(
-                self.opts, self.base.sack.query().available())
-            providers = query.filter(provides__glob=list(pkgs))
-            pkgs = set()
-            for pkg in providers.latest().run():
-                po = PackageWrapper(pkg)
-                try:
-                    pkgs.add(fmt_fn(po))
-                except AttributeError as e:
-                    # catch that the user has specified attributes
-                    # there don't exist on the dnf Package object.
-                    raise dnf.exceptions.Error(str(e))
-        for pkg in sorted(pkgs):
+            deps = self.get_deps(q)
+            self.timer.mark('deps', deps)
+            exact, globs = split_deps(self.base.sack, deps)
+            providers = self.resolve(exact, globs)
+            self.timer.mark('resolve', providers)
+            if self.opts.show_origin:
+                self.format_origins(providers, exact, globs, fmt_fn, out)
+            else:
+                self.format_pkgs(providers, fmt_fn, out)
+        elif self.opts.packageatr:
+            for dep in self.get_deps(q):
+                out.add(dep)
+        elif self.opts.show_origin:
+            self.format_matches(q, fmt_fn, out)
+        else:
+            self.format_pkgs(q, fmt_fn, out)
+        self.timer.mark('format')
+        out.close()
+        self.timer.mark('output')
+
+    def get_deps(self, query):
+        """Return capabilities of packages in query selected by packageatr."""
+        deps = set()
+        if self.opts.packageatr:
+            for pkg in query.run():
+                for rel in getattr(pkg, self.opts.packageatr):
+                    deps.add(str(rel))
+        else:
+            fmt_fn = build_format_fn(self.opts)
+            self.format_pkgs(query, fmt_fn, deps)
+        return deps
+
+    def unsatisfied(self, query):
+        """Check dependencies of installed packages in query.
+
+        Return a list of (package, missing requires, conflicting packages,
+        obsoleted packages) for every package having any of them, the same
+        problems a verify Goal reports. Requires are first looked up among the
+        names of all installed provides, only versioned and unknown ones are
+        left to libsolv. Like rpm, obsoletes only match package names, other
+        versions of the package itself are not reported.
+
+        """
+        installed = self.base.sack.query().installed()
+        provided = set()
+        for pkg in installed.run():
+            for provide in pkg.provides:
+                provided.add(str(provide).split(' ', 1)[0])
+        providers = {}
+
+        def installed_providers(reldep):
+            dep = str(reldep)
+            if dep not in providers:
+                providers[dep] = installed.filter(provides=reldep).run()
+            return providers[dep]
+
+        problems = []
+        for pkg in sorted(query.installed().run()):
+            missing = []
+            for reldep in pkg.requires:
+                dep = str(reldep)
+                if dep.startswith('rpmlib(') or dep in provided:
+                    continue
+                if not installed_providers(reldep):
+                    missing.append(dep)
+            conflicts = []
+            for reldep in pkg.conflicts:
+                conflicts.extend(conflict for conflict in
+                                 installed_providers(reldep) if conflict != pkg)
+            obsoleted = []
+            for reldep in pkg.obsoletes:
+                name = str(reldep).split(' ', 1)[0]
+                if name == pkg.name:
+                    continue
+                # every package provides its own name and EVR
+                obsoleted.extend(other for other in installed_providers(reldep)
+                                 if other.name == name)
+            if missing or conflicts or obsoleted:
+                problems.append((pkg, missing, conflicts, obsoleted))
+        return problems
+
+    def show_unsatisfied(self, query):
+        for pkg, missing, conflicts, obsoleted in self.unsatisfied(query):
+            if self.opts.output == 'jsonl':
+                print(json.dumps(collections.OrderedDict([
+                    ('package', str(pkg)), ('requires', missing),
+                    ('conflicts', [str(conflict) for conflict in conflicts]),
+                    ('obsoletes', [str(other) for other in obsoleted])])))
+                continue
             print(pkg)
+            for dep in missing:
+                print(_('    nothing provides %s') % dep)
+            for conflict in conflicts:
+                print(_('    conflicts with %s') % conflict)
+            for other in obsoleted:
+                print(_('    obsoletes installed %s') % other)
+
+    def resolve(self, exact, globs):
+        """Return the latest available packages providing the capabilities.
+
+        Exact capabilities are looked up in the provides of the sack in a
+        single pass, only the globs need to be matched against all of them.
+
+        """
+        query = self.filter_repo_arch(
+            self.opts, self.base.sack.query().available())
+        pkgs = []
+        if exact:
+            pkgs += query.filter(provides=[rdep for _dep, rdep in exact]).run()
+        if globs:
+            pkgs += query.filter(provides__glob=globs).run()
+        return query.filter(pkg=pkgs).latest()
 
-    def grow_tree(self, level, pkg):
+    @staticmethod
+    def format_origins(providers, exact, globs, fmt_fn, out):
+        """Show which of the providers every capability resolved to."""
+        for dep, reldep in exact:
+            for pkg in providers.filter(provides=reldep).run():
+                out.add('%s : %s' % (dep, format_pkg(fmt_fn, pkg)))
+        for dep in globs:
+            for pkg in providers.filter(provides__glob=dep).run():
+                out.add('%s : %s' % (dep, format_pkg(fmt_fn, pkg)))
+
+    def pattern_matchers(self):
+        """Return (pattern, filter) pairs of the patterns of the query.
+
+        Every filter narrows a query down to the packages its pattern
+        matches.
+
+        """
+        matchers = []
+        for pattern in self.opts.file or []:
+            matchers.append(
+                (pattern, lambda q, pattern=pattern: q.filter(file=pattern)))
+        for pattern in self.opts.whatprovides or []:
+            matchers.append(
+                (pattern,
+                 lambda q, pattern=pattern: q.filter(provides__glob=pattern)))
+        for pattern in self.opts.whatrequires or []:
+            if self.opts.alldeps:
+                # by_all_deps() has cached the packages of every pattern
+                matchers.append(
+                    (pattern, lambda q, pattern=pattern: q.filter(
+                        pkg=self._alldeps_cache[pattern][1].run())))
+            else:
+                matchers.append(
+                    (pattern, lambda q, pattern=pattern: q.filter(
+                        requires__glob=pattern)))
+        return matchers
+
+    def format_matches(self, query, fmt_fn, out):
+        """Show which of the packages in query every pattern matched.
+
+        The patterns are only matched against the result of the combined
+        filter.
+
+        """
+        for pattern, match in self.pattern_matchers():
+            for pkg in match(query).run():
+                out.add('%s : %s' % (pattern, format_pkg(fmt_fn, pkg)))
+
+    def format_pkgs(self, query, fmt_fn, out):
+        if self.opts.jobs > 1:
+            lines = parallel_format(query.run(), fmt_fn, self.opts.jobs)
+        else:
+            lines = (format_pkg(fmt_fn, pkg) for pkg in query.run())
+        for line in lines:
+            out.add(line)
+
+    def grow_tree(self, level, pkg, repeated=False):
         if level == -1:
             print(pkg)
             return
@@ -412,29 +1678,60 @@ class RepoQueryCommand(dnf.cli.Command):
         for reqirepkg in pkg.requires:
             requires.append(str(reqirepkg))
         reqstr = "[" + str(len(requires)) + ": " + ", ".join(requires) + "]"
+        if repeated:
+            # already expanded in this tree, do not expand it again
+            reqstr += " *"
         print(spacing + "\_ " + str(pkg) + " " + reqstr)
 
-    def tree_seed(self, query, aquery, opts, level=-1, usedpkgs=None):
-        for pkg in sorted(set(query.run()), key=lambda p: p.name):
-            usedpkgs = set() if usedpkgs is None or level is -1 else usedpkgs
-            if pkg.name.startswith("rpmlib") or pkg.name.startswith("solvable"):
-                return
-            self.grow_tree(level, pkg)
-            if pkg not in usedpkgs:
+    def providers(self, dep):
+        """Return packages providing dep, cached for the whole run."""
+        key = str(dep)
+        pkgs = self._providers_cache.get(key)
+        if pkgs is None:
+            pkgs = self.base.sack.query().filter(provides=dep).run()
+            self._providers_cache[key] = pkgs
+        return pkgs
+
+    def tree_children(self, pkg, aquery, opts):
+        """Return the sorted packages shown under pkg in the tree."""
+        children = self._tree_cache.get(pkg)
+        if children is not None:
+            return children
+        if opts.packageatr:
+            ar = {}
+            for dep in set(getattr(pkg, opts.packageatr)):
+                for provider in self.providers(dep):
+                    ar[provider.name + "." + provider.arch] = provider
+            children = ar.values()
+        elif opts.alldeps:
+            children = self.by_all_deps(pkg.name, aquery).run()
+        else:
+            children = aquery.filter(requires__glob=pkg.name).run()
+        children = sorted(set(children), key=lambda p: p.name)
+        self._tree_cache[pkg] = children
+        return children
+
+    def tree_seed(self, query, aquery, opts):
+        self._providers_cache = {}
+        self._tree_cache = {}
+        for root in sorted(set(query.run()), key=lambda p: p.name):
+            usedpkgs = set()
+            # walk the tree depth first, children are pushed in reverse order
+            # so that they are printed sorted by name
+            stack = [(-1, root)]
+            while stack:
+                level, pkg = stack.pop()
+                if pkg.name.startswith("rpmlib") or pkg.name.startswith("solvable"):
+                    continue
+                if pkg in usedpkgs:
+                    self.grow_tree(level, pkg, repeated=True)
+                    continue
+                self.grow_tree(level, pkg)
                 usedpkgs.add(pkg)
-                if opts.packageatr:
-                    strpkg = getattr(pkg, opts.packageatr)
-                    ar = {}
-                    for name in set(strpkg):
-                        pkgquery = self.base.sack.query().filter(provides=name)
-                        for querypkg in pkgquery:
-                            ar[querypkg.name + "." + querypkg.arch] = querypkg
-                    pkgquery = self.base.sack.query().filter(
-                        pkg=list(ar.values()))
-                else:
-                    pkgquery = self.by_all_deps(pkg.name, aquery) if opts.alldeps else aquery.filter(
-                        requires__glob=pkg.name)
-                self.tree_seed(pkgquery, aquery, opts, level + 1, usedpkgs)
+                if opts.tree_depth is not None and level + 1 >= opts.tree_depth:
+                    continue
+                for child in reversed(self.tree_children(pkg, aquery, opts)):
+                    stack.append((level + 1, child))
 
 
 class PackageWrapper(object):
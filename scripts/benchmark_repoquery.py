@@ -0,0 +1,353 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2015 Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+
+"""Benchmark dnf repoquery on synthetic repositories.
+
+A repository of the requested number of packages is generated offline, with
+provides, requires and files resembling a distribution: a few libraries are
+required by most of the packages, most libraries by only a few. Every mode of
+repoquery is then timed on it with DNF using the plugins of this source tree,
+the results including the --timings-json stages are written as JSON:
+
+    PYTHONPATH=./plugins scripts/benchmark_repoquery.py --sizes 10000,100000 \\
+        --output results.json
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# all times in the generated metadata are relative to this one, so that
+# repositories generated with the same seed are identical
+EPOCH = 1420070400
+
+PLUGINS_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'plugins')
+
+# name, repoquery arguments; %(pkg)s is a package in the middle of the
+# dependency chains, %(lib)s the library required by most packages, other
+# % characters like the tags of --qf are passed as they are
+MODES = (
+    ('nevra', []),
+    ('info', ['--info']),
+    ('queryformat', ['--qf', '%{name} %{requires} %{buildtime}']),
+    ('keys', ['%(pkg)s', 'pkg0001*', 'pkg00020.x86_64']),
+    ('whatrequires', ['--whatrequires', '%(lib)s']),
+    ('whatrequires-index', ['--use-index', '--whatrequires', '%(lib)s']),
+    ('alldeps', ['--whatrequires', 'pkg00000', '--alldeps']),
+    ('resolve', ['--requires', '--resolve', '%(pkg)s']),
+    ('tree', ['--requires', '--tree', '--tree-depth', '4', '%(pkg)s']),
+    ('srpm', ['--srpm']),
+    ('latest-limit', ['--latest-limit', '1']),
+    ('jsonl', ['--output', 'jsonl', '--qf', '%{name} %{requires}']),
+    ('jobs', ['--jobs', '4', '--info']),
+)
+
+PRIMARY_PKG = """\
+<package type="rpm">
+  <name>%(name)s</name>
+  <arch>%(arch)s</arch>
+  <version epoch="0" ver="%(version)s" rel="1"/>
+  <checksum type="sha256" pkgid="YES">%(pkgid)s</checksum>
+  <summary>Synthetic package %(name)s</summary>
+  <description>%(description)s</description>
+  <packager>Benchmark</packager>
+  <url>http://example.com/%(name)s</url>
+  <time file="%(buildtime)d" build="%(buildtime)d"/>
+  <size package="%(size)d" installed="%(size)d" archive="%(size)d"/>
+  <location href="Packages/%(name)s-%(version)s-1.%(arch)s.rpm"/>
+  <format>
+    <rpm:license>MIT</rpm:license>
+    <rpm:group>Unspecified</rpm:group>
+    <rpm:buildhost>benchmark</rpm:buildhost>
+    <rpm:sourcerpm>%(sourcerpm)s</rpm:sourcerpm>
+    <rpm:header-range start="0" end="1"/>
+    <rpm:provides>
+%(provides)s    </rpm:provides>
+    <rpm:requires>
+%(requires)s    </rpm:requires>
+%(primary_files)s  </format>
+</package>
+"""
+
+ENTRY = '      <rpm:entry name="%s"/>\n'
+VERSIONED_ENTRY = \
+    '      <rpm:entry name="%s" flags="EQ" epoch="0" ver="%s" rel="1"/>\n'
+
+REPOMD_DATA = """\
+  <data type="%(type)s">
+    <checksum type="sha256">%(checksum)s</checksum>
+    <open-checksum type="sha256">%(open_checksum)s</open-checksum>
+    <location href="repodata/%(type)s.xml.gz"/>
+    <timestamp>%(timestamp)d</timestamp>
+    <size>%(size)d</size>
+    <open-size>%(open_size)d</open-size>
+  </data>
+"""
+
+
+def lib_name(index):
+    return 'libpkg%05d.so.1()(64bit)' % index
+
+
+def synthetic_packages(count, fanout, seed):
+    """Generate dicts describing count binary packages and their sources.
+
+    Requires are drawn with a strong bias towards the first packages, so the
+    first libraries are required by most of the packages like glibc is.
+
+    """
+    rand = random.Random(seed)
+    for index in range(count):
+        name = 'pkg%05d' % index
+        version = '%d.%d' % (index % 7 + 1, index % 3)
+        requires = set()
+        if index:
+            for _ in range(rand.randint(0, 2 * fanout)):
+                requires.add(lib_name(int(index * rand.random() ** 3)))
+        files = ['/usr/lib64/libpkg%05d.so.1' % index,
+                 '/usr/share/doc/%s/README' % name]
+        if index % 10 == 0:
+            files.append('/usr/bin/%s' % name)
+        pkg = {
+            'name': name,
+            'arch': 'x86_64',
+            'version': version,
+            'pkgid': hashlib.sha256(name.encode('utf-8')).hexdigest(),
+            'description': 'Package %s used by the benchmark.' % name,
+            'buildtime': EPOCH - rand.randint(0, 365 * 24 * 60 * 60),
+            'size': rand.randint(10000, 10000000),
+            'sourcerpm': '%s-%s-1.src.rpm' % (name, version),
+            'provides': [(name, version), (lib_name(index), None)],
+            'requires': sorted(requires),
+            'files': files,
+        }
+        yield pkg
+        src = dict(pkg, arch='src', sourcerpm='', requires=[], files=[],
+                   provides=[(name, version)])
+        src['pkgid'] = hashlib.sha256(
+            (name + '.src').encode('utf-8')).hexdigest()
+        yield src
+
+
+def escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def primary_xml(pkg):
+    provides = ''.join(VERSIONED_ENTRY % (escape(name), version) if version
+                       else ENTRY % escape(name)
+                       for name, version in pkg['provides'])
+    requires = ''.join(ENTRY % escape(name) for name in pkg['requires'])
+    # primary metadata carries only the commonly required files
+    primary_files = ''.join('    <file>%s</file>\n' % fn for fn in pkg['files']
+                            if '/bin/' in fn)
+    return PRIMARY_PKG % dict(pkg, provides=provides, requires=requires,
+                              primary_files=primary_files)
+
+
+def filelists_xml(pkg):
+    files = ''.join('<file>%s</file>' % fn for fn in pkg['files'])
+    return '<package pkgid="%(pkgid)s" name="%(name)s" arch="%(arch)s">' \
+        '<version epoch="0" ver="%(version)s" rel="1"/>%(files)s</package>\n' \
+        % dict(pkg, files=files)
+
+
+def other_xml(pkg):
+    return '<package pkgid="%(pkgid)s" name="%(name)s" arch="%(arch)s">' \
+        '<version epoch="0" ver="%(version)s" rel="1"/></package>\n' % pkg
+
+
+def write_metadata(repodir, md_type, header, footer, chunks):
+    """Write gzipped metadata, return its repomd.xml record."""
+    content = (header + ''.join(chunks) + footer).encode('utf-8')
+    path = os.path.join(repodir, 'repodata', '%s.xml.gz' % md_type)
+    with open(path, 'wb') as md_file:
+        with gzip.GzipFile(fileobj=md_file, mode='wb', mtime=0) as gz_file:
+            gz_file.write(content)
+    with open(path, 'rb') as md_file:
+        compressed = md_file.read()
+    return REPOMD_DATA % {
+        'type': md_type,
+        'checksum': hashlib.sha256(compressed).hexdigest(),
+        'open_checksum': hashlib.sha256(content).hexdigest(),
+        'timestamp': EPOCH,
+        'size': len(compressed),
+        'open_size': len(content)}
+
+
+def create_repo(repodir, count, fanout, seed):
+    os.makedirs(os.path.join(repodir, 'repodata'))
+    pkgs = list(synthetic_packages(count, fanout, seed))
+    records = [
+        write_metadata(
+            repodir, 'primary',
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+            'xmlns:rpm="http://linux.duke.edu/metadata/rpm" '
+            'packages="%d">\n' % len(pkgs),
+            '</metadata>\n', (primary_xml(pkg) for pkg in pkgs)),
+        write_metadata(
+            repodir, 'filelists',
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<filelists xmlns="http://linux.duke.edu/metadata/filelists" '
+            'packages="%d">\n' % len(pkgs),
+            '</filelists>\n', (filelists_xml(pkg) for pkg in pkgs)),
+        write_metadata(
+            repodir, 'other',
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<otherdata xmlns="http://linux.duke.edu/metadata/other" '
+            'packages="%d">\n' % len(pkgs),
+            '</otherdata>\n', (other_xml(pkg) for pkg in pkgs))]
+    with io.open(os.path.join(repodir, 'repodata', 'repomd.xml'), 'w',
+                 encoding='utf-8') as repomd:
+        repomd.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                     '<repomd xmlns="http://linux.duke.edu/metadata/repo" '
+                     'xmlns:rpm="http://linux.duke.edu/metadata/rpm">\n'
+                     '  <revision>%d</revision>\n' % EPOCH)
+        repomd.write(''.join(records))
+        repomd.write('</repomd>\n')
+
+
+def write_config(topdir, repodir):
+    """Write dnf.conf using only the synthetic repo, return its path."""
+    reposdir = os.path.join(topdir, 'repos.d')
+    os.makedirs(reposdir)
+    with io.open(os.path.join(reposdir, 'benchmark.repo'), 'w',
+                 encoding='utf-8') as repo:
+        repo.write('[benchmark]\nname=benchmark\nbaseurl=file://%s\n'
+                   'enabled=1\ngpgcheck=0\nmetadata_expire=never\n' % repodir)
+    conf = os.path.join(topdir, 'dnf.conf')
+    with io.open(conf, 'w', encoding='utf-8') as conf_file:
+        conf_file.write('[main]\ncachedir=%s\nreposdir=%s\n'
+                        'pluginpath=%s\ngpgcheck=0\n' % (
+                            os.path.join(topdir, 'cache'), reposdir,
+                            PLUGINS_DIR))
+    return conf
+
+
+def dnf_command(topdir, conf):
+    return [sys.executable, '-m', 'dnf.cli.main', '-q', '-y', '-c', conf,
+            '--installroot', os.path.join(topdir, 'root'),
+            '--disableplugin=*', '--enableplugin=Query']
+
+
+def run_mode(topdir, conf, args, repeat):
+    """Run repoquery repeat times, return timing of the fastest run."""
+    timings_fn = os.path.join(topdir, 'timings.json')
+    best = None
+    for _ in range(repeat):
+        cmd = dnf_command(topdir, conf) + ['-C', 'repoquery',
+                                           '--timings-json', timings_fn] + args
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(cmd, stdout=devnull)
+        wall = time.time() - start
+        if best is None or wall < best['wall']:
+            with open(timings_fn) as timings:
+                best = {'wall': wall, 'stages': json.load(timings)}
+    return best
+
+
+def mode_args(args, values):
+    """Return args with the %(name)s placeholders of values filled in."""
+    filled = []
+    for arg in args:
+        for name, value in values.items():
+            arg = arg.replace('%%(%s)s' % name, value)
+        filled.append(arg)
+    return filled
+
+
+def benchmark(count, opts):
+    topdir = tempfile.mkdtemp(prefix='repoquery-benchmark-')
+    try:
+        repodir = os.path.join(topdir, 'repo')
+        create_repo(repodir, count, opts.fanout, opts.seed)
+        conf = write_config(topdir, repodir)
+        # download the metadata and build the solv cache once
+        subprocess.check_call(dnf_command(topdir, conf) + ['makecache'])
+        values = {'pkg': 'pkg%05d' % (count // 2), 'lib': lib_name(0)}
+        results = []
+        for name, args in MODES:
+            if opts.modes and name not in opts.modes:
+                continue
+            args = mode_args(args, values)
+            result = run_mode(topdir, conf, args, opts.repeat)
+            result.update({'mode': name, 'args': args})
+            results.append(result)
+            print('%8d %-20s %8.3f s' % (count, name, result['wall']),
+                  file=sys.stderr)
+        return {'packages': count, 'results': results}
+    finally:
+        if opts.keep:
+            print('Kept %s' % topdir, file=sys.stderr)
+        else:
+            shutil.rmtree(topdir)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='10000,100000',
+                        help='comma separated numbers of binary packages')
+    parser.add_argument('--fanout', type=int, default=8,
+                        help='average number of requires of a package')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the generated repositories')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of every mode, the fastest one is kept')
+    parser.add_argument('--mode', dest='modes', action='append',
+                        choices=[name for name, _args in MODES],
+                        help='run only this mode, can be repeated')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated repositories')
+    parser.add_argument('--output', default='-',
+                        help='file to write the JSON results to')
+    return parser.parse_args()
+
+
+def main():
+    opts = parse_args()
+    report = {'time': int(time.time()), 'python': sys.version.split()[0],
+              'benchmarks': [benchmark(int(size), opts)
+                             for size in opts.sizes.split(',')]}
+    text = json.dumps(report, indent=2)
+    if opts.output == '-':
+        print(text)
+    else:
+        with io.open(opts.output, 'w', encoding='utf-8') as output:
+            output.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
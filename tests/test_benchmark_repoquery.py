@@ -0,0 +1,45 @@
+# Copyright (C) 2015 Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# the GNU General Public License v.2, or (at your option) any later version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY expressed or implied, including the implied warranties of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.  You should have received a copy of the
+# GNU General Public License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.  Any Red Hat trademarks that are incorporated in the
+# source code or documentation are not subject to the GNU General Public
+# License and may only be used or replicated with the express permission of
+# Red Hat, Inc.
+#
+
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'scripts'))
+import benchmark_repoquery
+
+
+class ModeArgsTest(unittest.TestCase):
+    def test_modes(self):
+        values = {'pkg': 'pkg00050', 'lib': benchmark_repoquery.lib_name(0)}
+        for name, args in benchmark_repoquery.MODES:
+            filled = benchmark_repoquery.mode_args(args, values)
+            self.assertEqual(len(filled), len(args), name)
+            for arg in filled:
+                self.assertNotIn('%(', arg, name)
+
+    def test_mode_args(self):
+        values = {'pkg': 'pkg00050', 'lib': 'libfoo.so.1'}
+        self.assertEqual(
+            benchmark_repoquery.mode_args(
+                ['--qf', '%{name} %{requires}', '%(pkg)s', '%(lib)s'], values),
+            ['--qf', '%{name} %{requires}', 'pkg00050', 'libfoo.so.1'])
@@ -20,35 +20,220 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from tests.support import mock
+
+import errno
 import needs_restarting
+import os
+import shutil
+import sys
+import tempfile
 import tests.support
 
+if sys.version_info.major >= 3:
+    from io import StringIO
+else:
+    from StringIO import StringIO
+
 DEL_FILE = '3dcf000000-3dcf032000 r-xp 00000000 08:02 140759                ' \
            '         /usr/lib64/libXfont.so.1.4.1;5408628d (deleted)'
 MM_FILE = '7fc4e1168000-7fc4e1169000 rw-s 1096dd000 00:05 7749' \
           '                      /dev/dri/card0'
+MEMFD_FILE = '7f1c2a000000-7f1c2a200000 rw-s 00000000 00:01 1035' \
+             '                       /memfd:pulseaudio (deleted)'
+BTRFS_FILE = '7f5d4b400000-7f5d4b428000 r--p 00000000 00:1f 3456' \
+             '                       /usr/lib64/libc.so.6'
+ANON_MAP = '7ffd6d5d2000-7ffd6d5f3000 rw-p 00000000 00:00 0' \
+           '                          [stack]'
+SPACE_FILE = '7f2a3c000000-7f2a3c021000 r--p 00000000 fd:01 2755' \
+             '                       /opt/my app/lib/libapp.so\n'
 SO_FILE = '30efe06000-30efe07000 r--p 00006000 08:02 139936' \
           '                         /usr/lib64/libSM.so.6.0.1'
 
 
 class NeedsRestartingTest(tests.support.TestCase):
-    def test_smap2opened_file(self):
-        func = needs_restarting.smap2opened_file
-        self.assertIsNone(func(1, 'Shared_Dirty:          0 kB'))
+    def test_map2opened_file(self):
+        func = needs_restarting.map2opened_file
+        self.assertIsNone(func(1, ANON_MAP))
         self.assertIsNone(func(1, MM_FILE))
+        self.assertIsNone(func(1, MEMFD_FILE))
+
+        # btrfs and overlayfs use devices of major 0
+        ofile = func(5, BTRFS_FILE)
+        self.assertEqual(ofile.name, '/usr/lib64/libc.so.6')
+        self.assertEqual(ofile.inode, 3456)
+        self.assertEqual(ofile.dev, os.makedev(0, 0x1f))
 
         ofile = func(5, SO_FILE)
         self.assertFalse(ofile.deleted)
         self.assertEqual(ofile.name, '/usr/lib64/libSM.so.6.0.1')
         self.assertEqual(ofile.pid, 5)
+        self.assertEqual(ofile.inode, 139936)
 
         ofile = func(5, DEL_FILE)
         self.assertTrue(ofile.deleted)
         self.assertEqual(ofile.name, '/usr/lib64/libXfont.so.1.4.1;5408628d')
 
+        ofile = func(5, SPACE_FILE)
+        self.assertEqual(ofile.name, '/opt/my app/lib/libapp.so')
+
+    def test_read_maps(self):
+        tmpdir = tempfile.mkdtemp()
+        maps = os.path.join(tmpdir, 'maps')
+        try:
+            with open(maps, 'w') as maps_file:
+                maps_file.write('\n'.join(
+                    (SO_FILE, SO_FILE, ANON_MAP, DEL_FILE, SO_FILE)) + '\n')
+            ofiles = needs_restarting.read_maps(7, maps)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual([(ofile.pid, ofile.name) for ofile in ofiles],
+                         [(7, '/usr/lib64/libSM.so.6.0.1'),
+                          (7, '/usr/lib64/libXfont.so.1.4.1;5408628d')])
+
 
 class OpenedFileTest(tests.support.TestCase):
     def test_presumed_name(self):
         ofile = needs_restarting.OpenedFile(
             100, '/usr/lib64/libgtk-3.so.0.1000.9;54085c6e', True)
         self.assertEqual(ofile.presumed_name, '/usr/lib64/libgtk-3.so.0.1000.9')
+
+
+class OwningPackagesTest(tests.support.TestCase):
+    def test_owning_packages(self):
+        glibc = mock.Mock(files=['/usr/lib64/libc.so.6', '/usr/bin/ldd'])
+        libsm = mock.Mock(files=['/usr/lib64/libSM.so.6.0.1'])
+        sack = mock.Mock()
+        query = sack.query.return_value.installed.return_value
+        query.filter.return_value.run.return_value = [glibc, libsm]
+        owners = needs_restarting.owning_packages(
+            sack, ['/usr/lib64/libc.so.6', '/usr/lib64/libSM.so.6.0.1',
+                   '/usr/lib64/libc.so.6', '/opt/foo'])
+        self.assertEqual(owners, {'/usr/lib64/libc.so.6': glibc,
+                                  '/usr/lib64/libSM.so.6.0.1': libsm})
+        self.assertEqual(query.filter.call_count, 1)
+        self.assertEqual(
+            set(query.filter.call_args[1]['file']),
+            {'/usr/lib64/libc.so.6', '/usr/lib64/libSM.so.6.0.1', '/opt/foo'})
+
+
+class ScanTest(tests.support.TestCase):
+    def test_scan_process_exited(self):
+        process_start = mock.Mock(side_effect=IOError(errno.ENOENT, 'gone'))
+        with mock.patch('needs_restarting.logger') as logger:
+            self.assertIsNone(
+                needs_restarting.scan_process(1, None, process_start))
+            self.assertFalse(logger.warning.called)
+            process_start.side_effect = IOError(errno.EACCES, 'denied')
+            self.assertIsNone(
+                needs_restarting.scan_process(1, None, process_start))
+            self.assertTrue(logger.warning.called)
+
+    @mock.patch('needs_restarting.list_pids', lambda: iter(range(1, 41)))
+    @mock.patch('needs_restarting.read_maps', lambda pid, maps: [pid])
+    def test_scan_processes(self):
+        # odd processes exit before they are scanned
+        def process_start(pid):
+            if pid % 2:
+                raise IOError(errno.ENOENT, 'gone')
+            return pid * 10
+        results = needs_restarting.scan_processes(None, process_start, 4)
+        self.assertEqual(sorted(results), [(pid, pid * 10, [pid], None)
+                                           for pid in range(2, 41, 2)])
+
+    def test_read_unit(self):
+        tmpdir = tempfile.mkdtemp()
+        cgroup = os.path.join(tmpdir, 'cgroup')
+        try:
+            units = []
+            for content in (
+                    '0::/system.slice/sshd.service\n',
+                    '11:cpu,cpuacct:/\n1:name=systemd:/system.slice/'
+                    'httpd.service\n',
+                    '0::/user.slice/user-1000.slice/user@1000.service/'
+                    'app.slice/gnome-terminal.service/tab\n',
+                    '0::/user.slice/user-1000.slice/session-2.scope\n',
+                    '0::/init.scope\n',
+                    '0::/\n',
+                    '0::/user.slice/user-1000.slice/user@1000.service\n'):
+                with open(cgroup, 'w') as cgroup_file:
+                    cgroup_file.write(content)
+                units.append(needs_restarting.read_unit(cgroup))
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(units, ['sshd.service', 'httpd.service',
+                                 'gnome-terminal.service (user@1000.service)',
+                                 None, None, None, 'user@1000.service'])
+
+
+class ReplacedFilesTest(tests.support.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, 'libfoo.so.1')
+        with open(self.fn, 'w') as lib:
+            lib.write('foo')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_replaced_files(self):
+        pid = os.getpid()
+        st = os.stat(self.fn)
+        current = needs_restarting.OpenedFile(pid, self.fn, False, st.st_ino,
+                                              st.st_dev)
+        replaced = needs_restarting.OpenedFile(pid, self.fn, False,
+                                               st.st_ino + 1, st.st_dev)
+        # the same inode number on another file system
+        other_dev = needs_restarting.OpenedFile(pid, self.fn, False,
+                                                st.st_ino, st.st_dev + 1)
+        deleted = needs_restarting.OpenedFile(pid, self.fn + ';5408628d',
+                                              True, st.st_ino + 2, st.st_dev)
+        # above the largest possible pid, i.e. an exited process
+        exited = needs_restarting.OpenedFile(1 << 23, self.fn, False,
+                                             st.st_ino + 3, st.st_dev)
+        self.assertEqual(
+            needs_restarting.replaced_files(
+                [current, replaced, other_dev, deleted, exited]),
+            [replaced, other_dev, deleted])
+
+    def test_replaced_files_root(self):
+        # paths are looked up under the root directory of the process
+        inode = os.stat(self.fn).st_ino
+        ofile = needs_restarting.OpenedFile(os.getpid(), self.fn, False, inode)
+        with mock.patch('os.stat', wraps=os.stat) as stat:
+            needs_restarting.replaced_files([ofile])
+        stat.assert_called_with('/proc/%d/root%s' % (os.getpid(), self.fn))
+
+    def test_replaced_pids(self):
+        cmd = needs_restarting.NeedsRestartingCommand(mock.Mock())
+        st = os.stat(self.fn)
+        ofiles = [needs_restarting.OpenedFile(os.getpid(), self.fn, False,
+                                              st.st_ino, st.st_dev)]
+        self.assertEqual(cmd.replaced_pids(ofiles), set())
+        self.assertFalse(cmd.base.fill_sack.called)
+
+        ofiles += [needs_restarting.OpenedFile(2, self.fn + ';5408628d', True),
+                   needs_restarting.OpenedFile(3, '/dev/shm/tmp', True)]
+        with mock.patch('needs_restarting.owning_packages',
+                        return_value={self.fn: mock.Mock()}):
+            self.assertEqual(cmd.replaced_pids(ofiles), {2})
+        cmd.base.fill_sack.assert_called_once_with(
+            load_system_repo=True, load_available_repos=False)
+
+
+class ServicesTest(tests.support.TestCase):
+    @mock.patch('needs_restarting.print_cmd')
+    @mock.patch('needs_restarting.ProcessStart', mock.Mock())
+    def test_services(self, print_cmd):
+        scanned = [(1, 0, [], 'httpd.service'), (2, 0, [], 'httpd.service'),
+                   (3, 0, [], None), (4, 0, [], 'sshd.service'),
+                   (5, 0, [], 'crond.service')]
+        cmd = needs_restarting.NeedsRestartingCommand(mock.Mock())
+        cmd.configure(['--services'])
+        cmd.updated_pids = mock.Mock(return_value={1, 2, 3, 4})
+        with mock.patch('needs_restarting.scan_processes',
+                        return_value=iter(scanned)), \
+                mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            cmd.run([])
+        self.assertEqual(stdout.getvalue(), 'httpd.service\nsshd.service\n')
+        print_cmd.assert_called_once_with(3)
@@ -22,9 +22,21 @@ from __future__ import unicode_literals
 from tests.support import mock
 
 import dnf.exceptions
+import hawkey
+import os
 import repoquery
+import shutil
+import socket
+import sys
+import tempfile
+import threading
 import unittest
 
+if sys.version_info.major >= 3:
+    from io import StringIO
+else:
+    from StringIO import StringIO
+
 EXPECTED_INFO_FORMAT = """\
 Name        : foobar
 Version     : 1.0.1
@@ -64,15 +76,22 @@ class PkgStub(object):
         self.url = 'foorl.net'
         self.version = '1.0.1'
         self.files = ['/tmp/foobar', '/var/foobar']
+        self.requires = ['libc.so.6', 'bash']
 
 
 class ArgParseTest(unittest.TestCase):
     def test_parse(self):
         opts, _ = repoquery.parse_arguments(['--whatrequires', 'prudence'])
         self.assertIsNone(opts.whatprovides)
-        self.assertEqual(opts.whatrequires, 'prudence')
+        self.assertEqual(opts.whatrequires, ['prudence'])
         self.assertEqual(opts.queryformat, repoquery.QFORMAT_DEFAULT)
 
+    def test_multiple_patterns(self):
+        opts, _ = repoquery.parse_arguments(
+            ['--whatprovides', 'foo', '--whatprovides', 'bar*', '-f', '/a'])
+        self.assertEqual(opts.whatprovides, ['foo', 'bar*'])
+        self.assertEqual(opts.file, ['/a'])
+
     @mock.patch('argparse.ArgumentParser.print_help', lambda x: x)
     def test_conflict(self):
         with self.assertRaises(dnf.exceptions.Error):
@@ -88,24 +107,45 @@ class ArgParseTest(unittest.TestCase):
         opts, _ = repoquery.parse_arguments(['/var/foobar'])
         self.assertIsNone(opts.file)
 
+    def test_filelists_needed(self):
+        for args in (['-l'], ['--file', '/bin/sh'], ['--resolve'],
+                     ['--whatprovides', '/usr/bin/ls'], ['/usr/bin/ls'],
+                     ['--qf', '%{name} %{files}'],
+                     ['--output', 'jsonl', '--list']):
+            opts, _ = repoquery.parse_arguments(args)
+            self.assertTrue(repoquery.filelists_needed(opts), args)
+        for args in ([], ['-i'], ['bash'], ['--whatprovides', 'webserver'],
+                     ['--whatrequires', '/bin/sh'], ['--qf', '%{requires}']):
+            opts, _ = repoquery.parse_arguments(args)
+            self.assertFalse(repoquery.filelists_needed(opts), args)
+
+    def test_stream(self):
+        opts, _ = repoquery.parse_arguments([])
+        self.assertFalse(opts.stream)
+        opts, _ = repoquery.parse_arguments(['--stream'])
+        self.assertTrue(opts.stream)
+
 class InfoFormatTest(unittest.TestCase):
     def test_info(self):
-        pkg = repoquery.PackageWrapper(PkgStub())
-        self.assertEqual(repoquery.info_format(pkg), EXPECTED_INFO_FORMAT)
+        opts, _ = repoquery.parse_arguments(['--info'])
+        self.assertEqual(repoquery.build_format_fn(opts)(PkgStub()),
+                         EXPECTED_INFO_FORMAT)
 
 
 class FilelistFormatTest(unittest.TestCase):
     def test_filelist(self):
-        pkg = repoquery.PackageWrapper(PkgStub())
-        self.assertEqual(repoquery.filelist_format(pkg),
+        opts, _ = repoquery.parse_arguments(['--list'])
+        self.assertEqual(repoquery.build_format_fn(opts)(PkgStub()),
                          EXPECTED_FILELIST_FORMAT)
 
+
 class SourceRPMFormatTest(unittest.TestCase):
     def test_info(self):
-        pkg = repoquery.PackageWrapper(PkgStub())
-        self.assertEqual(repoquery.sourcerpm_format(pkg),
+        opts, _ = repoquery.parse_arguments(['--source'])
+        self.assertEqual(repoquery.build_format_fn(opts)(PkgStub()),
                          EXPECTED_SOURCERPM_FORMAT)
 
+
 class OutputTest(unittest.TestCase):
     def test_output(self):
         pkg = PkgStub()
@@ -121,6 +161,561 @@ class OutputTest(unittest.TestCase):
                          "'PkgStub' object has no attribute 'notfound'")
 
 
+class QueryFormatterTest(unittest.TestCase):
+    def test_info(self):
+        fmt = repoquery.QueryFormatter(repoquery.QUERY_INFO)
+        self.assertEqual(fmt(PkgStub()), EXPECTED_INFO_FORMAT)
+
+    def test_filelist(self):
+        fmt = repoquery.QueryFormatter('{0.files}')
+        self.assertEqual(fmt(PkgStub()), EXPECTED_FILELIST_FORMAT)
+
+    def test_list_tag(self):
+        fmt = repoquery.QueryFormatter(repoquery.rpm2py_format('%{requires}'))
+        self.assertEqual(fmt(PkgStub()), 'bash\nlibc.so.6')
+
+        # any tag holding a list is rendered one value per line
+        pkg = PkgStub()
+        pkg.prereqs = ['libc.so.6', 'bash']
+        fmt = repoquery.QueryFormatter(repoquery.rpm2py_format('%{prereqs}'))
+        self.assertEqual(fmt(pkg), 'bash\nlibc.so.6')
+
+    def test_padding(self):
+        fmt = repoquery.QueryFormatter(
+            repoquery.rpm2py_format('%-8{name}|%8{arch}|%{reponame}'))
+        self.assertEqual(fmt(PkgStub()), '  foobar|x86_64  |@System')
+
+    def test_fallback(self):
+        fmt = repoquery.QueryFormatter('{0.name!r}')
+        self.assertEqual(fmt(PkgStub()), repr('foobar'))
+
+    def test_illegal_attr(self):
+        fmt = repoquery.QueryFormatter(repoquery.rpm2py_format('%{notfound}'))
+        with self.assertRaises(AttributeError):
+            fmt(PkgStub())
+
+
+class SplitKeysTest(unittest.TestCase):
+    def test_split_keys(self):
+        keys = ['bash', 'py*', 'glibc-2.22', 'kernel.x86_64', 'lib?',
+                '/usr/bin/ls', 'zsh', '1:foo']
+        names, globs, others = repoquery.split_keys(keys)
+        self.assertEqual(names, ['bash', 'zsh'])
+        self.assertEqual(globs, ['py*', 'lib?'])
+        self.assertEqual(others, ['glibc-2.22', 'kernel.x86_64',
+                                  '/usr/bin/ls', '1:foo'])
+
+
+class AllDepsTest(unittest.TestCase):
+    def test_by_all_deps(self):
+        pkg = mock.Mock(provides=['libfoo.so.1', 'foo'], files=['/usr/bin/foo'])
+        results = {'name': [pkg], 'requires__glob': [1],
+                   'requires': lambda deps: [3] if deps[0][0] == '/' else [2]}
+        query = mock.Mock()
+
+        def filter_(**kw):
+            (key, value), = kw.items()
+            result = results.get(key)
+            return QueryListStub(result(value) if callable(result) else result)
+        query.filter.side_effect = filter_
+        cmd = repoquery.RepoQueryCommand(mock.Mock())
+        alldeps = cmd.by_all_deps('foo', query)
+        query.filter.assert_any_call(requires=['libfoo.so.1', 'foo'])
+        query.filter.assert_any_call(requires=['/usr/bin/foo'])
+        query.filter.assert_called_with(pkg=[1, 2, 3])
+        calls = query.filter.call_count
+        self.assertIs(cmd.by_all_deps('foo', query), alldeps)
+        self.assertEqual(query.filter.call_count, calls)
+
+
+class RevDepIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        pkgs = []
+        for name, requires in (('foo', ['bar >= 1.0', '/bin/sh']),
+                               ('baz', ['bar', '(qux if quux)'])):
+            pkg = mock.Mock(requires=requires, recommends=[], suggests=[],
+                            supplements=[], enhances=[])
+            pkg.name = name
+            pkgs.append(pkg)
+        self.sack = mock.Mock()
+        self.sack.query.return_value = QueryListStub(pkgs)
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def test_fingerprint(self):
+        repomd_fn = os.path.join(self.cachedir, 'repomd.xml')
+        with open(repomd_fn, 'w') as repomd:
+            repomd.write('<repomd/>')
+        repo = mock.Mock(id='fedora', exclude=[])
+        repo.metadata.repomd_fn = repomd_fn
+        cmd = repoquery.RepoQueryCommand(mock.Mock())
+        cmd.base.repos.iter_enabled.return_value = [repo]
+        cmd.base.sack.rpmdb_version.return_value = '1:abc'
+        cmd.base.conf.exclude = []
+        fingerprint = cmd.metadata_fingerprint()
+        self.assertEqual(cmd.metadata_fingerprint(), fingerprint)
+        # excludes change the packages the index is built from
+        cmd.base.conf.exclude = ['bash']
+        self.assertNotEqual(cmd.metadata_fingerprint(), fingerprint)
+        cmd.base.conf.exclude = []
+        repo.exclude = ['bash']
+        self.assertNotEqual(cmd.metadata_fingerprint(), fingerprint)
+
+    def test_dep_names(self):
+        self.assertEqual(repoquery.dep_names('foo >= 1.0'), ['foo'])
+        self.assertEqual(repoquery.dep_names('(foo or bar > 2)'),
+                         ['foo', 'bar', '2'])
+
+    def test_lookup(self):
+        index = repoquery.RevDepIndex.open(self.sack, self.cachedir, 'abc')
+        self.assertEqual(index.lookup('requires', 'bar'), ['baz', 'foo'])
+        self.assertEqual(index.lookup('requires', 'bar < 2'), ['baz', 'foo'])
+        self.assertEqual(index.lookup('requires', '/bin/sh'), ['foo'])
+        self.assertEqual(index.lookup('requires', 'quux'), ['baz'])
+        self.assertEqual(index.lookup('requires', 'missing'), [])
+        self.assertEqual(index.lookup('recommends', 'bar'), [])
+        self.assertIsNone(index.lookup('requires', 'ba*'))
+
+    @mock.patch('repoquery.INDEX_KEEP', 1)
+    def test_rebuild(self):
+        repoquery.RevDepIndex.open(self.sack, self.cachedir, 'abc')
+        repoquery.RevDepIndex.open(self.sack, self.cachedir, 'def')
+        self.assertEqual(os.listdir(os.path.join(self.cachedir, 'repoquery')),
+                         ['revdeps-def'])
+        self.assertEqual(self.sack.query.call_count, 2)
+        repoquery.RevDepIndex.open(self.sack, self.cachedir, 'def')
+        self.assertEqual(self.sack.query.call_count, 2)
+
+
+def reldep_stub(sack, dep):
+    if dep.startswith('('):
+        raise hawkey.ValueException('Wrong reldep')
+    return 'reldep(%s)' % dep
+
+
+class ResolveTest(unittest.TestCase):
+    @mock.patch('hawkey.Reldep', reldep_stub, create=True)
+    def test_split_deps(self):
+        exact, globs = repoquery.split_deps(
+            None, ['bash >= 4', 'lib*.so', '(a or b)', '/bin/sh'])
+        self.assertEqual(exact, [('bash >= 4', 'reldep(bash >= 4)'),
+                                 ('/bin/sh', 'reldep(/bin/sh)')])
+        self.assertEqual(globs, ['lib*.so', '(a or b)'])
+
+    def test_format_origins(self):
+        providers = mock.Mock()
+        providers.filter.side_effect = lambda **kw: QueryListStub(
+            [PkgStub()] if kw.get('provides') == 'reldep(bash)' or
+            kw.get('provides__glob') == 'foo*' else [])
+        out = set()
+        repoquery.RepoQueryCommand.format_origins(
+            providers, [('bash', 'reldep(bash)'), ('zsh', 'reldep(zsh)')],
+            ['foo*'], lambda pkg: pkg.name, out)
+        self.assertEqual(out, {'bash : foobar', 'foo* : foobar'})
+
+
+class PatternsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, 'patterns')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_from_file(self):
+        with open(self.fn, 'w') as patterns:
+            patterns.write('# providers\n--whatprovides webserver\n\n'
+                           '--whatprovides "foo >= 1"\n-f /etc/foo.conf\n')
+        opts, _ = repoquery.parse_arguments(
+            ['--whatprovides', 'bar', '--from-file', self.fn])
+        repoquery.read_patterns(opts, opts.from_file)
+        self.assertEqual(opts.whatprovides, ['bar', 'webserver', 'foo >= 1'])
+        self.assertEqual(opts.file, ['/etc/foo.conf'])
+        self.assertIsNone(opts.whatrequires)
+
+    def test_from_file_invalid(self):
+        opts, _ = repoquery.parse_arguments([])
+        with open(self.fn, 'w') as patterns:
+            patterns.write('--whatprovides foo\n--installed\n')
+        with self.assertRaises(dnf.exceptions.Error):
+            repoquery.read_patterns(opts, self.fn)
+        with open(self.fn, 'w') as patterns:
+            patterns.write('--whatprovides foo\n--whatprovides "bar\n')
+        with self.assertRaises(dnf.exceptions.Error) as ctx:
+            repoquery.read_patterns(opts, self.fn)
+        self.assertTrue(str(ctx.exception).startswith(self.fn + ':2: '))
+        with self.assertRaises(dnf.exceptions.Error):
+            repoquery.read_patterns(opts, os.path.join(self.tmpdir, 'missing'))
+
+    def test_by_revdep(self):
+        cmd = repoquery.RepoQueryCommand(mock.Mock())
+        cmd.opts, _ = repoquery.parse_arguments(['--use-index'])
+        index = mock.Mock()
+        index.lookup.side_effect = lambda dep, pattern: {
+            'bar': ['foo'], 'baz': ['qux']}.get(pattern)
+        cmd.open_index = lambda cls: index
+        query = mock.Mock()
+        query.filter.return_value = query
+        cmd.by_revdep(query, 'requires', ['bar', 'baz'])
+        self.assertEqual(set(query.filter.call_args_list[0][1]['name']),
+                         {'foo', 'qux'})
+        query.filter.assert_called_with(requires__glob=['bar', 'baz'])
+        # the index can not answer globs, only the combined filter is used
+        query.reset_mock()
+        cmd.by_revdep(query, 'requires', ['bar', 'ba*'])
+        query.filter.assert_called_once_with(requires__glob=['bar', 'ba*'])
+
+    def test_format_matches(self):
+        cmd = repoquery.RepoQueryCommand(mock.Mock())
+        cmd.opts, _ = repoquery.parse_arguments(
+            ['--whatprovides', 'foo*', '--whatprovides', 'bash', '-f', '/a'])
+        query = mock.Mock()
+        query.run.return_value = [PkgStub()]
+        query.filter.side_effect = lambda **kw: QueryListStub(
+            [PkgStub()] if kw in ({'provides__glob': 'foo*'},
+                                  {'file': '/a'}) else [])
+        out = set()
+        cmd.format_matches(query, repoquery.QueryFormatter('{0.name}'), out)
+        self.assertEqual(out, {'foo* : foobar', '/a : foobar'})
+
+
+class UnsatisfiedTest(unittest.TestCase):
+    def test_unsatisfied(self):
+        bash = EvrPkgStub('bash', '4')
+        bash.provides = ['bash = 4', '/bin/sh']
+        bash.requires = ['glibc', 'rpmlib(Foo)', 'libfoo.so.1', 'bash >= 3']
+        bash.conflicts = ['zsh']
+        bash.obsoletes = ['bash < 4']
+        zsh = EvrPkgStub('zsh', '5')
+        zsh.provides = ['zsh = 5', 'glibc']
+        zsh.requires = ['/bin/sh']
+        zsh.conflicts = []
+        # obsoletes match package names, tcsh only provides csh
+        zsh.obsoletes = ['ksh < 2', 'csh']
+        ksh = EvrPkgStub('ksh', '1')
+        ksh.provides = ['ksh = 1']
+        ksh.requires = ksh.conflicts = ksh.obsoletes = []
+        tcsh = EvrPkgStub('tcsh', '6')
+        tcsh.provides = ['tcsh = 6', 'csh']
+        tcsh.requires = tcsh.conflicts = tcsh.obsoletes = []
+        installed = QueryListStub([bash, zsh, ksh, tcsh])
+        lookups = {'bash >= 3': [bash], '/bin/sh': [bash], 'zsh': [zsh],
+                   'bash < 4': [bash], 'ksh < 2': [ksh], 'csh': [tcsh]}
+        installed.filter = \
+            lambda provides: QueryListStub(lookups.get(provides, []))
+        installed.installed = lambda: installed
+        cmd = repoquery.RepoQueryCommand(mock.Mock())
+        cmd.base.sack.query.return_value = installed
+        self.assertEqual(cmd.unsatisfied(installed),
+                         [(bash, ['libfoo.so.1'], [zsh], []),
+                          (zsh, [], [], [ksh])])
+
+
+class EvrPkgStub(object):
+    def __init__(self, name, evr, reponame='fedora', arch='x86_64'):
+        self.name = name
+        self.evr = evr
+        self.arch = arch
+        self.reponame = reponame
+
+    def __lt__(self, other):
+        return self.evr < other.evr
+
+    def __repr__(self):
+        return '%s-%s@%s' % (self.name, self.evr, self.reponame)
+
+
+class SrpmTest(unittest.TestCase):
+    def test_by_srpm(self):
+        src = PkgStub()
+        src.name, src.arch = 'foo', 'src'
+        binaries = [PkgStub(), PkgStub(), PkgStub()]
+        binaries[2].sourcerpm = None
+        cmd = repoquery.RepoQueryCommand(mock.Mock())
+        sack = cmd.base.sack
+        sack.query.return_value.filter.return_value = QueryListStub([src])
+        cmd.by_srpm(QueryListStub(binaries))
+        cmd.by_srpm(QueryListStub(binaries))
+        sack.query.return_value.filter.assert_any_call(arch='src')
+        sack.query.return_value.filter.assert_called_with(pkg=[src])
+        self.assertEqual(
+            sack.query.return_value.filter.call_args_list.count(
+                mock.call(arch='src')), 1)
+
+
+class ServeTest(unittest.TestCase):
+    def test_answer(self):
+        cmd = repoquery.RepoQueryCommand(mock.Mock())
+
+        def run_query():
+            print(' '.join(cmd.opts.whatrequires))
+        cmd.run_query = run_query
+        self.assertEqual(cmd.answer(['--whatrequires', 'bash']),
+                         {'output': 'bash\n', 'error': None})
+        response = cmd.answer(['--serve', 'sock'])
+        self.assertEqual(response['error'], '--serve can not be nested.')
+        for args in (['--cache'], ['--from-file', 'list'], ['--profile', 'p'],
+                     ['--timings'], ['--timings-json', 't'], ['--srpm']):
+            self.assertIsNotNone(cmd.answer(args)['error'], args)
+        cmd._serve_srpm = True
+        self.assertIsNone(
+            cmd.answer(['--srpm', '--whatrequires', 'bash'])['error'])
+
+    def test_answer_exception(self):
+        cmd = repoquery.RepoQueryCommand(mock.Mock())
+        cmd.run_query = mock.Mock(side_effect=KeyError('foo'))
+        with mock.patch('repoquery.logger') as logger:
+            response = cmd.answer(['bash'])
+        self.assertTrue(logger.exception.called)
+        self.assertEqual(response['output'], '')
+        self.assertIn('foo', response['error'])
+
+    def test_prepare_serve(self):
+        cmd = repoquery.RepoQueryCommand(mock.Mock())
+        cmd.opts, _ = repoquery.parse_arguments(
+            ['--serve', 'sock', '--use-index', '--srpm'])
+        cmd.metadata_fingerprint = mock.Mock(return_value='abc')
+        query = cmd.base.sack.query.return_value
+        query.filter.return_value = query.installed.return_value = query
+        query.run.return_value = []
+        indexes = {repoquery.BuildtimeIndex: mock.Mock(),
+                   repoquery.RevDepIndex: mock.Mock()}
+
+        def open_index(cls):
+            cmd._indexes[cls] = indexes[cls]
+            return indexes[cls]
+        cmd.open_index = open_index
+        cmd.prepare_serve()
+        self.assertIsNotNone(cmd._srpm_index)
+        self.assertIsNotNone(cmd._installonly)
+        self.assertEqual(cmd._fingerprint, 'abc')
+        self.assertEqual(cmd._indexes,
+                         {repoquery.BuildtimeIndex: indexes[
+                             repoquery.BuildtimeIndex]})
+        indexes[repoquery.RevDepIndex].close.assert_called_once_with()
+
+    def test_serve_umask(self):
+        cmd = repoquery.RepoQueryCommand(mock.Mock())
+        cmd.opts, _ = repoquery.parse_arguments(['--serve', 'sock'])
+        cmd.prepare_serve = mock.Mock()
+        umasks = []
+
+        def server(path, command):
+            umask = os.umask(0)
+            os.umask(umask)
+            umasks.append(umask)
+            return mock.Mock()
+        with mock.patch('repoquery.QueryServer', server), \
+                mock.patch('os.unlink'):
+            cmd.serve('/nonexistent/sock')
+        self.assertEqual(umasks, [0o077])
+
+    def test_server(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'sock')
+        command = mock.Mock()
+        command.answer.side_effect = \
+            lambda args: {'output': ' '.join(args), 'error': None}
+        server = repoquery.QueryServer(path, command)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            client.sendall(b'--whatrequires "a b"\n\n--installed\n')
+            client.shutdown(socket.SHUT_WR)
+            response = client.makefile('rb').read().decode('utf-8')
+            client.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            shutil.rmtree(tmpdir)
+        self.assertEqual(response,
+                         '{"output": "--whatrequires a b", "error": null}\n'
+                         '{"output": "--installed", "error": null}\n')
+
+
+class BuildtimeIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def test_names_since(self):
+        pkgs = []
+        for name, buildtime in (('foo', 300), ('bar', 100), ('baz', 200),
+                                ('qux', 200)):
+            pkg = PkgStub()
+            pkg.name, pkg.buildtime = name, buildtime
+            pkgs.append(pkg)
+        sack = mock.Mock()
+        sack.query.return_value = QueryListStub(pkgs)
+        index = repoquery.BuildtimeIndex.open(sack, self.cachedir, 'abc')
+        self.assertEqual(index.names_since(150), {'foo', 'baz', 'qux'})
+        self.assertEqual(index.names_since(200), {'foo'})
+        self.assertEqual(index.names_since(300), set())
+        self.assertEqual(index.names_since(0), {'foo', 'bar', 'baz', 'qux'})
+
+    @mock.patch('repoquery.INDEX_KEEP', 2)
+    def test_keep(self):
+        sack = mock.Mock()
+        sack.query.return_value = QueryListStub([])
+        topdir = os.path.join(self.cachedir, 'repoquery')
+        for fingerprint, mtime in (('abc', 100), ('def', 200)):
+            repoquery.BuildtimeIndex.open(sack, self.cachedir, fingerprint)
+            os.utime(os.path.join(topdir, 'buildtimes-' + fingerprint),
+                     (mtime, mtime))
+        # using an index makes it the most recent one
+        repoquery.BuildtimeIndex.open(sack, self.cachedir, 'abc')
+        repoquery.BuildtimeIndex.open(sack, self.cachedir, 'ghi')
+        self.assertEqual(sorted(os.listdir(topdir)),
+                         ['buildtimes-abc', 'buildtimes-ghi'])
+        self.assertEqual(sack.query.call_count, 3)
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.cache = repoquery.ResultCache(
+            os.path.join(self.cachedir, 'results'), 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def test_key(self):
+        opts, _parser = repoquery.parse_arguments(['--whatrequires', 'foo'])
+        key = repoquery.ResultCache.key(opts, {'repos': [['base', 'abc']]})
+        opts, _parser = repoquery.parse_arguments(
+            ['--whatrequires', 'foo', '--jobs', '4', '--cache'])
+        self.assertEqual(
+            repoquery.ResultCache.key(opts, {'repos': [['base', 'abc']]}), key)
+        self.assertNotEqual(
+            repoquery.ResultCache.key(opts, {'repos': [['base', 'def']]}), key)
+        opts, _parser = repoquery.parse_arguments(['--whatrequires', 'bar'])
+        self.assertNotEqual(
+            repoquery.ResultCache.key(opts, {'repos': [['base', 'abc']]}), key)
+
+    def test_conf_values(self):
+        conf = mock.Mock(spec=['exclude', 'installonlypkgs'],
+                         exclude=['kernel*', 'foo'], installonlypkgs=[])
+        self.assertEqual(
+            repoquery.ResultCache.conf_values(
+                conf, ('exclude', 'installonlypkgs', 'include')),
+            [['exclude', ['foo', 'kernel*']], ['installonlypkgs', []],
+             ['include', None]])
+
+    def test_cache_sources(self):
+        cmd = repoquery.RepoQueryCommand(mock.Mock())
+        cmd.base.repos.iter_enabled.return_value = []
+        cmd.base.conf.installroot = self.cachedir
+        cmd.base.conf.substitutions = {'releasever': '23'}
+        cmd.base.conf.exclude = []
+        sources = cmd.cache_sources()
+        cmd.base.conf.exclude = ['bash']
+        self.assertNotEqual(cmd.cache_sources(), sources)
+
+    def test_get(self):
+        self.assertIsNone(self.cache.get('abc'))
+        self.cache.put('abc', 'foo-1.0\n')
+        self.assertEqual(self.cache.get('abc'), 'foo-1.0\n')
+
+    def test_evict(self):
+        for key in ('abc', 'def'):
+            self.cache.put(key, 'a' * 20)
+        # the least recently used output goes first
+        os.utime(os.path.join(self.cachedir, 'results', 'abc.gz'), (0, 0))
+        self.cache.max_size = os.path.getsize(
+            os.path.join(self.cachedir, 'results', 'def.gz'))
+        self.cache.evict()
+        self.assertIsNone(self.cache.get('abc'))
+        self.assertEqual(self.cache.get('def'), 'a' * 20)
+
+    @mock.patch('repoquery.rpm', None)
+    def test_rpmdb_cookie(self):
+        dbpath = os.path.join(self.cachedir, 'var', 'lib', 'rpm')
+        self.assertEqual(repoquery.rpmdb_cookie(self.cachedir), '')
+        os.makedirs(dbpath)
+        with open(os.path.join(dbpath, 'Packages'), 'w') as packages:
+            packages.write('a')
+        cookie = repoquery.rpmdb_cookie(self.cachedir)
+        with open(os.path.join(dbpath, 'Packages'), 'w') as packages:
+            packages.write('ab')
+        self.assertNotEqual(repoquery.rpmdb_cookie(self.cachedir), cookie)
+
+    def test_rpmdb_cookie_dbpath(self):
+        dbpath = os.path.join(self.cachedir, 'usr', 'lib', 'sysimage', 'rpm')
+        os.makedirs(dbpath)
+        with open(os.path.join(dbpath, 'rpmdb.sqlite'), 'w') as rpmdb:
+            rpmdb.write('a')
+        rpm = mock.Mock()
+        rpm.expandMacro.return_value = '/usr/lib/sysimage/rpm'
+        with mock.patch('repoquery.rpm', rpm, create=True):
+            cookie = repoquery.rpmdb_cookie(self.cachedir)
+        rpm.expandMacro.assert_called_once_with('%_dbpath')
+        self.assertTrue(cookie.startswith('rpmdb.sqlite:'))
+
+
+class TreePkgStub(object):
+    def __init__(self, name):
+        self.name = name
+        self.requires = []
+
+    def __str__(self):
+        return self.name
+
+
+class QueryListStub(object):
+    def __init__(self, pkgs):
+        self._pkgs = pkgs
+
+    def run(self):
+        return self._pkgs
+
+
+class TreeTest(unittest.TestCase):
+    def setUp(self):
+        self.a, self.b, self.c = [TreePkgStub(n) for n in 'abc']
+        graph = {self.a: [self.b, self.c], self.b: [self.a], self.c: [self.b]}
+        self.cmd = repoquery.RepoQueryCommand(mock.Mock())
+        self.cmd.tree_children = lambda pkg, aquery, opts: graph[pkg]
+
+    def tree(self, depth=None):
+        opts = mock.Mock(tree_depth=depth)
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            self.cmd.tree_seed(QueryListStub([self.a]), None, opts)
+        return stdout.getvalue()
+
+    def test_cycle(self):
+        self.assertEqual(self.tree(), 'a\n'
+                                      ' \\_ b [0: ]\n'
+                                      ' |   \\_ a [0: ] *\n'
+                                      ' \\_ c [0: ]\n'
+                                      ' |   \\_ b [0: ] *\n')
+
+    def test_depth(self):
+        self.assertEqual(self.tree(depth=1), 'a\n'
+                                             ' \\_ b [0: ]\n'
+                                             ' \\_ c [0: ]\n')
+
+    def test_depth_without_tree(self):
+        self.cmd.opts, self.cmd.parser = repoquery.parse_arguments(
+            ['--tree-depth', '2', 'a'])
+        with self.assertRaises(dnf.exceptions.Error):
+            self.cmd.run_query()
+
+    def test_providers(self):
+        # cached from the start, not only within tree_seed()
+        self.cmd.base.sack.query.return_value.filter.return_value.run \
+            .return_value = [self.b]
+        self.assertEqual(self.cmd.providers('b'), [self.b])
+        self.assertEqual(self.cmd.providers('b'), [self.b])
+        self.assertEqual(self.cmd.base.sack.query.call_count, 1)
+
+
 class Rpm2PyFormatTest(unittest.TestCase):
     def test_rpm2py_format(self):
         fmt = repoquery.rpm2py_format('%{name}')
@@ -131,3 +726,132 @@ class Rpm2PyFormatTest(unittest.TestCase):
         self.assertEqual(fmt, '{0.name:>40}')
         fmt = repoquery.rpm2py_format('%{name}-%{repoid} :: %-40{arch}')
         self.assertEqual(fmt, '{0.name}-{0.repoid} :: {0.arch:>40}')
+
+
+class OutputSinkTest(unittest.TestCase):
+    def test_sorted(self):
+        out = repoquery.SortedOutput()
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            for line in ('b', 'a', 'b'):
+                out.add(line)
+            self.assertEqual(stdout.getvalue(), '')
+            out.close()
+        self.assertEqual(stdout.getvalue(), 'a\nb\n')
+
+    def test_stream(self):
+        out = repoquery.StreamOutput(batch_size=2)
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            out.add('b')
+            out.add('b')
+            self.assertEqual(stdout.getvalue(), '')
+            out.add('a')
+            self.assertEqual(stdout.getvalue(), 'b\na\n')
+            out.add('c')
+            out.add('a')
+            out.close()
+        self.assertEqual(stdout.getvalue(), 'b\na\nc\n')
+
+    def test_stream_nul(self):
+        out = repoquery.StreamOutput(terminator='\0')
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            out.add('a\nb')
+            out.add('c')
+            out.close()
+        self.assertEqual(stdout.getvalue(), 'a\nb\0c\0')
+
+    def test_stream_unicode(self):
+        out = repoquery.StreamOutput()
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            out.add('\u017eluva')
+            out.add('\u017eluva')
+            out.close()
+        self.assertEqual(stdout.getvalue(), '\u017eluva\n')
+
+
+class ParallelFormatTest(unittest.TestCase):
+    def test_parallel_format(self):
+        pkgs = []
+        for name in ('d', 'a', 'c', 'b', 'a', 'e', 'f'):
+            pkg = PkgStub()
+            pkg.name = name
+            pkgs.append(pkg)
+        lines = repoquery.parallel_format(pkgs, lambda pkg: pkg.name * 2, 3)
+        self.assertEqual(list(lines), ['aa', 'bb', 'cc', 'dd', 'ee', 'ff'])
+
+    def test_error(self):
+        fmt = repoquery.QueryFormatter('{0.notfound}')
+        lines = repoquery.parallel_format([PkgStub(), PkgStub()], fmt, 2)
+        self.assertRaises(dnf.exceptions.Error, list, lines)
+
+    def test_streaming(self):
+        cmd = repoquery.RepoQueryCommand(mock.Mock())
+        for args in (['--stream'], ['--output', 'jsonl'], ['--output', 'nul']):
+            cmd.opts, cmd.parser = repoquery.parse_arguments(
+                ['--jobs', '2'] + args)
+            with self.assertRaises(dnf.exceptions.Error):
+                cmd.run_query()
+
+
+class StageTimerTest(unittest.TestCase):
+    def test_disabled(self):
+        timer = repoquery.StageTimer(False)
+        timer.mark('keys', [1, 2])
+        self.assertEqual(timer.stages, [])
+
+    def test_mark(self):
+        timer = repoquery.StageTimer(True)
+        timer.mark('keys', [1, 2])
+        timer.mark('format')
+        self.assertEqual([(stage['stage'], stage['size'])
+                          for stage in timer.stages],
+                         [('keys', 2), ('format', None)])
+        self.assertGreaterEqual(timer.stages[0]['wall'], 0)
+        with mock.patch('sys.stderr', new_callable=StringIO) as stderr:
+            timer.report()
+        lines = stderr.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].startswith('keys '))
+        self.assertTrue(lines[1].endswith(' 2'))
+        self.assertTrue(lines[2].endswith(' -'))
+
+    def test_mark_query(self):
+        timer = repoquery.StageTimer(True)
+        clock = [0.0]
+        timer._now = lambda: (clock[0], clock[0])
+        timer._last = (0.0, 0.0)
+        query = mock.Mock()
+
+        def run():
+            # evaluating the query is the expensive part of the stage
+            clock[0] += 5
+            return [1, 2, 3]
+        query.run.side_effect = run
+        timer.mark('filters', query)
+        self.assertEqual(timer.stages[0]['size'], 3)
+        self.assertEqual(timer.stages[0]['wall'], 5)
+
+
+class RecordOutputTest(unittest.TestCase):
+    def test_output_tags(self):
+        opts, _ = repoquery.parse_arguments(['--output', 'jsonl'])
+        self.assertEqual(repoquery.output_tags(opts),
+                         ['name', 'epoch', 'version', 'release', 'arch'])
+        opts, _ = repoquery.parse_arguments(
+            ['--output', 'csv', '--qf', '%{NAME} %-10{requires} %{name}'])
+        self.assertEqual(repoquery.output_tags(opts), ['name', 'requires'])
+        opts, _ = repoquery.parse_arguments(['--output', 'csv', '-l'])
+        self.assertEqual(repoquery.output_tags(opts), ['files'])
+
+    def test_jsonl(self):
+        fmt = repoquery.JsonFormatter(['name', 'size', 'requires'])
+        self.assertEqual(
+            fmt(PkgStub()),
+            '{"name": "foobar", "size": 100, "requires": ["bash", "libc.so.6"]}')
+
+    def test_csv(self):
+        pkg = PkgStub()
+        pkg.summary = 'say "hi", world'
+        fmt = repoquery.CsvFormatter(['name', 'summary', 'files'])
+        self.assertEqual(fmt.header(), 'name,summary,files')
+        self.assertEqual(fmt(pkg),
+                         'foobar,"say ""hi"", world","/tmp/foobar\n/var/foobar"')